@@ -0,0 +1,842 @@
+# Fitting the model-based controller's settings to a recorded calibration run
+#
+# Used by shell_autotune once MODEL_CALIBRATE has recorded a run, and offline on trace files:
+#
+#   import autotune_fit
+#   tune = autotune_fit.get('heattest_200')
+#   tune.calc_params()
+#
+# Kept apart from shell_autotune so the printer host doesn't load any of this until it's needed.
+# numpy, scipy, shelve, hashlib, concurrent.futures and multiprocessing are still only imported
+# where they're used, and matplotlib only by plot_sink when plots are enabled.
+import math, logging
+import bisect, collections
+from array import array
+import model
+import plot_sink
+import shell_autotune
+import trace_file
+
+
+# bump whenever a change to the fitting procedure changes its results, so stored fits
+# (see fleet.py) are redone
+FITTER_VERSION = 2
+
+TARGET_IS_HIGHER = -1
+TARGET_IS_LOWER = 1
+EPSILON = 0.0005  # how closely to tune model parameters
+
+# generator for binary search! initialize with bounds, and give feedback via
+# send(TARGET_IS_LOWER/HIGHER)! Only the lower bound needs to be correct
+def bin_search_float(lower, upper):
+    # exponential growth first to find upper bound
+    feedback = yield upper
+    while feedback is TARGET_IS_HIGHER:
+        lower = upper
+        upper *= 2.0
+        feedback = yield upper
+    while abs(upper - lower) > EPSILON:
+        current = (lower + upper) / 2.0
+        feedback = yield current
+        assert not feedback is None
+        if feedback is TARGET_IS_HIGHER:
+            lower = current
+            continue
+        if feedback is TARGET_IS_LOWER:
+            upper = current
+            continue
+
+# Parallel variant of bin_search_float: speculatively evaluates the next levels of its decision
+# tree at once. Yields lists of up to k probe points and expects one feedback value per probe back
+# (TARGET_IS_HIGHER / TARGET_IS_LOWER, or None if the probe hit the target exactly). It then follows
+# the path bin_search_float would have taken, so it probes the same points, stops at the same one
+# and returns the value bin_search_float would have ended on, with log2(k+1) levels per round.
+def _bisect_probe(state):
+    exploring, lower, upper, _ = state
+    return upper if exploring else (lower + upper) / 2.0
+
+def _bisect_step(state, feedback):
+    # state: (still growing the upper bound, lower, upper, last probe), as in bin_search_float
+    exploring, lower, upper, _ = state
+    probe = _bisect_probe(state)
+    if exploring:
+        if feedback is TARGET_IS_HIGHER:
+            return (True, upper, upper * 2.0, probe)
+        return (False, lower, upper, probe)
+    if feedback is TARGET_IS_HIGHER:
+        return (False, probe, upper, probe)
+    return (False, lower, probe, probe)
+
+def _bisect_done(state):
+    exploring, lower, upper, _ = state
+    return not exploring and abs(upper - lower) <= EPSILON
+
+def kary_search_float(lower, upper, k):
+    state = (True, lower, upper, None)
+    while True:
+        # breadth first, so every probe's ancestors are probed in the same round
+        nodes = [state]
+        for node in nodes:
+            if len(nodes) >= k:
+                break
+            for fb in (TARGET_IS_HIGHER, TARGET_IS_LOWER):
+                child = _bisect_step(node, fb)
+                if not _bisect_done(child) and len(nodes) < k:
+                    nodes.append(child)
+        probes = [_bisect_probe(node) for node in nodes]
+        feedback = yield probes
+        assert len(feedback) == len(probes)
+        results = dict(zip(probes, feedback))
+        while _bisect_probe(state) in results:
+            fb = results[_bisect_probe(state)]
+            if fb is None:
+                return _bisect_probe(state)
+            state = _bisect_step(state, fb)
+            if _bisect_done(state):
+                return state[3]
+
+
+# Process pool plumbing for parallel fitting: every worker keeps its own replay of the trace
+_worker_tune = None
+
+def _init_worker(timestamps, smoothed_samples, pwm_samples):
+    global _worker_tune
+    _worker_tune = TraceFit(OfflineHeater(), 0)
+    _worker_tune.timestamps = timestamps
+    _worker_tune.smoothed_samples = smoothed_samples
+    _worker_tune.pwm_samples = pwm_samples
+    _worker_tune.curve_snapshots.clear()
+
+def _replicate_in_worker(model_config, start_idx, end_idx, fan_power):
+    return _worker_tune._replicate_curve(model_config, start_idx, end_idx, fan_power)[1]
+
+
+def _canonical_config(model_config, fan_power):
+    # initial_temp is always taken from the trace at start_idx, so it doesn't affect replicated curves.
+    # Neither does fan_cooling with the fan off, or base_cooling with the fan at full speed
+    ignored = ['initial_temp']
+    if fan_power == 0.0:
+        ignored.append('fan_cooling')
+    elif fan_power == 1.0:
+        ignored.append('base_cooling')
+    return tuple(sorted((k, repr(float(v))) for k, v in model_config.items() if k not in ignored))
+
+
+# Memo of _replicate_curve results, keyed on the trace contents, the canonicalized model config
+# and the replicated range. Least recently used entries are evicted once max_entries is reached.
+# If a path is given, entries are also written through to a shelve database there, so a rerun
+# (e.g. after a crash, or after changing a single fit stage) doesn't have to simulate again.
+class ReplicationCache:
+    def __init__(self, max_entries=4096, path=None):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.store = None
+        if path is not None:
+            import shelve
+            self.store = shelve.open(path)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(trace_digest, model_config, start_idx, end_idx, fan_power):
+        import hashlib
+        text = repr((trace_digest, _canonical_config(model_config, fan_power), int(start_idx), int(end_idx), repr(float(fan_power))))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        samples = self.entries.get(key)
+        if samples is not None:
+            self.entries.move_to_end(key)
+        elif self.store is not None and key in self.store:
+            samples = self.store[key]
+            self._remember(key, samples)
+        if samples is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return samples
+
+    def put(self, key, samples):
+        self._remember(key, samples)
+        if self.store is not None:
+            self.store[key] = samples
+            self.store.sync()
+
+    def _remember(self, key, samples):
+        self.entries[key] = samples
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+DELTA_T = 0.5  # how many seconds back / forward to seek for computing momentary values
+
+
+def _fit_in_process(conn, target, samples, method):
+    # entry point of the fitting process started by CalibrationJob. Sends ('progress', message)
+    # tuples while fitting, then either ('done', config) or ('error', message)
+    try:
+        tune = TraceFit(OfflineHeater(), target)
+        tune.from_samples(*samples)
+        tune.progress = lambda message: conn.send(('progress', message))
+        config = tune.calc_params(method=method)
+        conn.send(('done', dict((key, float(val)) for key, val in config.items())))
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+    finally:
+        conn.close()
+
+# Fits the samples recorded by a live ControlAutoTune run in a separate process. The recorded
+# samples are handed over in memory, progress messages are polled from a reactor timer and
+# reported through gcode.respond_info, and the results are set in configfile for SAVE_CONFIG.
+class CalibrationJob:
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, printer, heater_name, calibrate, method='bisect'):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.gcode = printer.lookup_object('gcode')
+        self.heater_name = heater_name
+        self.target = calibrate.calibrate_temp
+        # ControlAutoTune holds on to the heater, so only the recorded samples go to the worker
+        self.samples = (array('d', calibrate.timestamps), array('d', calibrate.raw_samples), list(calibrate.pwm_samples),
+                dict(calibrate.phase_start), list(calibrate.smoothed_samples))
+        self.method = method
+        self.process = self.conn = self.timer = None
+        self.running = False
+
+    def start(self):
+        import multiprocessing
+        self.conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_fit_in_process,
+                args=(child_conn, self.target, self.samples, self.method))
+        self.process.daemon = True
+        self.process.start()
+        # the child's end is only needed in the child
+        child_conn.close()
+        self.running = True
+        self.timer = self.reactor.register_timer(self._poll, self.reactor.NOW)
+
+    def _poll(self, eventtime):
+        try:
+            while self.conn.poll():
+                kind, payload = self.conn.recv()
+                if kind == 'progress':
+                    self.gcode.respond_info("Model calibration: " + payload)
+                elif kind == 'done':
+                    self._apply(payload)
+                    return self._finish()
+                else:
+                    logging.error("Autotune: fitting failed: %s", payload)
+                    self.gcode.respond_info("Model calibration failed: " + payload)
+                    return self._finish()
+        except EOFError:
+            # the fitting process went away without a result
+            logging.error("Autotune: fitting process exited with code %s", self.process.exitcode)
+            self.gcode.respond_info("Model calibration failed: fitting process exited")
+            return self._finish()
+        return eventtime + self.POLL_INTERVAL
+
+    def _apply(self, config):
+        logging.info("Autotune: model config: " + str(config))
+        self.gcode.respond_info("Model parameters:\n"
+                + "\n".join(['model_' + setting + ": " + str(val) for setting, val in config.items()]))
+        # Store results for SAVE_CONFIG
+        configfile = self.printer.lookup_object('configfile')
+        for key, val in config.items():
+            setting = 'model_' + key
+            configfile.set(self.heater_name, setting, str(val))
+
+    def _finish(self):
+        self.running = False
+        self.conn.close()
+        self.process.join()
+        if self.timer is not None:
+            self.reactor.unregister_timer(self.timer)
+            self.timer = None
+        return self.reactor.NEVER
+
+    def cancel(self):
+        if not self.running:
+            return
+        self.process.terminate()
+        self._finish()
+
+SNAPSHOT_INTERVAL = 50  # samples between model state snapshots in CurveSnapshots
+
+# Model state snapshots of replicated curves. Successive fits replay overlapping ranges from the
+# same start index (e.g. heat_start..cool_start and heat_start..cool_end), so a run is identified by
+# (config, start_idx, fan_power) and a longer request resumes from the latest snapshot before its end.
+# Whole runs are evicted least recently used first once more than max_snapshots are stored.
+class CurveSnapshots:
+    def __init__(self, max_snapshots=2000):
+        self.max_snapshots = max_snapshots
+        self.runs = collections.OrderedDict()
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def run_key(self, model_config, start_idx, fan_power):
+        return (_canonical_config(model_config, fan_power), int(start_idx), float(fan_power))
+
+    def resume(self, run_key, end_idx):
+        # returns (tick, model state, pwm_idx, samples up to and including tick) or None
+        run = self.runs.get(run_key)
+        ticks = [] if run is None else [tick for tick in run['snapshots'] if tick <= end_idx]
+        if not ticks:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.runs.move_to_end(run_key)
+        tick = max(ticks)
+        state, pwm_idx = run['snapshots'][tick]
+        return tick, state, pwm_idx, run['samples'][:tick+1]
+
+    def save(self, run_key, tick, state, pwm_idx, samples):
+        run = self.runs.get(run_key)
+        if run is None:
+            run = self.runs[run_key] = {'snapshots': {}, 'samples': []}
+        self.runs.move_to_end(run_key)
+        if tick not in run['snapshots']:
+            self.count += 1
+        run['snapshots'][tick] = (state, pwm_idx)
+        # runs are deterministic, so only the samples past the stored ones are new
+        run['samples'].extend(samples[len(run['samples']):])
+        while self.count > self.max_snapshots and len(self.runs) > 1:
+            _, evicted = self.runs.popitem(last=False)
+            self.count -= len(evicted['snapshots'])
+
+    def clear(self):
+        self.runs.clear()
+        self.count = 0
+
+
+class TraceFit(shell_autotune.ControlAutoTune):
+    # A recorded calibration run (see from_file / from_samples) and the procedures fitting the
+    # model to it
+    def __init__(self, heater, target):
+        shell_autotune.ControlAutoTune.__init__(self, heater, target)
+        self.replication_cache = ReplicationCache()
+        self.curve_snapshots = CurveSnapshots()
+        # where candidate curves go, see plot_sink. Off by default so fitting never blocks
+        self.plots = plot_sink.PlotSink()
+        # called with a message whenever fitting enters a new stage, see CalibrationJob
+        self.progress = None
+        self._trace_digest = None
+        self._derivs = None
+        self._temp_indices = {}
+
+    def from_file(self, filename='heattest.txt'):
+        # accepts both the text format written by write_file and binary traces (see trace_file)
+        if trace_file.is_binary(filename):
+            timestamps, raw_samples, pwm, phase_start = trace_file.read_binary(filename)
+            pwm_samples = [(float(time), float(value)) for time, value in pwm]
+        else:
+            timestamps, raw_samples, pwm_samples, phase_start = trace_file.read_text(filename)
+        self.from_samples(timestamps, raw_samples, pwm_samples, phase_start)
+
+    def from_samples(self, timestamps, raw_samples, pwm_samples, phase_start, smoothed_samples=None):
+        # load a recorded run; the samples are smoothed here unless already given
+        self.phase = 'done'
+        self.timestamps = timestamps
+        self.raw_samples = raw_samples
+        self.pwm_samples = pwm_samples
+        self.phase_start = phase_start
+        if smoothed_samples is None:
+            smoothed_samples = self._smooth(raw_samples)
+        self.smoothed_samples = smoothed_samples
+        self._trace_digest = None
+        self._derivs = None
+        self._temp_indices = {}
+        self.curve_snapshots.clear()
+
+    def _lerp(self, a, b, alpha):
+        return a + alpha * (b - a)
+
+    def _replicate_curve(self, model_config, start_idx, end_idx, fan_power=0):
+        # Creates a model with the given config, and attempts to replicate the temperature
+        # curve between (start_idx, end_idx) in smoothed_samples
+        # pads the resulting list with start_idx many None values to make index calculation easier
+
+        overwritten = model_config['initial_temp']
+        model_config['initial_temp'] = self.smoothed_samples[start_idx]
+
+        m = model.Model(trace=0, **model_config)
+        run_key = self.curve_snapshots.run_key(model_config, start_idx, fan_power)
+        resume = self.curve_snapshots.resume(run_key, end_idx)
+        if resume is None:
+            first_tick = start_idx
+            pwm_idx = 0
+            model_temp_samples = ([None] * start_idx) + [self.smoothed_samples[start_idx]]
+        else:
+            # a previous run with the same config and start got (at least partially) this far already
+            first_tick, state, pwm_idx, model_temp_samples = resume
+            m.cells, m.time = list(state[0]), state[1]
+        time = self.timestamps[first_tick]
+        # pwm_idx is now the index of the last pwm_sample before current time, i.e. the active decision
+        for tick in range(first_tick+1, end_idx+1):
+            # Find the heater output decision that's relevant to know
+            while True:
+                if pwm_idx+1 < len(self.pwm_samples) and self.pwm_samples[pwm_idx+1][0] < time:
+                    pwm_idx += 1
+                else:
+                    break
+
+            time = self.timestamps[tick]
+            dt = self.timestamps[tick] - self.timestamps[tick-1]
+            new_temp = m.advance_model(dt, self.pwm_samples[pwm_idx][1], fan_power)
+            model_temp_samples.append(new_temp)
+            if (tick - start_idx) % SNAPSHOT_INTERVAL == 0 or tick == end_idx:
+                self.curve_snapshots.save(run_key, tick, (tuple(m.cells), m.time), pwm_idx, model_temp_samples)
+        model_config['initial_temp'] = overwritten
+        return (m, model_temp_samples)
+
+    def _trace_key(self):
+        if self._trace_digest is None:
+            import hashlib
+            h = hashlib.sha1()
+            h.update(repr([float(t) for t in self.timestamps]).encode('utf-8'))
+            h.update(repr([float(t) for t in self.smoothed_samples]).encode('utf-8'))
+            h.update(repr([(float(t), float(v)) for t, v in self.pwm_samples]).encode('utf-8'))
+            self._trace_digest = h.hexdigest()
+        return self._trace_digest
+
+    def _replication_key(self, model_config, start_idx, end_idx, fan_power=0):
+        return ReplicationCache.make_key(self._trace_key(), model_config, start_idx, end_idx, fan_power)
+
+    def _cached_samples(self, key, start_idx):
+        # cached curves are stored without the None padding
+        samples = self.replication_cache.get(key)
+        if samples is None:
+            return None
+        return ([None] * start_idx) + list(samples)
+
+    def _store_samples(self, key, start_idx, samples):
+        self.replication_cache.put(key, [float(t) for t in samples[start_idx:]])
+
+    def _replicate_samples(self, model_config, start_idx, end_idx, fan_power=0):
+        # Memoized variant of _replicate_curve that only returns the model temperature samples
+        key = self._replication_key(model_config, start_idx, end_idx, fan_power)
+        samples = self._cached_samples(key, start_idx)
+        if samples is None:
+            _, samples = self._replicate_curve(model_config, start_idx, end_idx, fan_power)
+            self._store_samples(key, start_idx, samples)
+        return samples
+
+    def _derivatives(self):
+        # Derivative of smoothed_samples at every sample, lerped between the slopes towards
+        # the nearest samples at least DELTA_T before and after it
+        if self._derivs is None:
+            import numpy as np
+            times = np.asarray(self.timestamps, dtype=float)
+            temps = np.asarray(self.smoothed_samples, dtype=float)
+            before_idx = np.maximum(np.searchsorted(times, times - DELTA_T, side='right') - 1, 0)
+            after_idx = np.minimum(np.searchsorted(times, times + DELTA_T, side='left'), len(times)-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                deriv_before = (temps - temps[before_idx]) / (times - times[before_idx])
+                deriv_after = (temps[after_idx] - temps) / (times[after_idx] - times)
+                alpha = (times - times[before_idx]) / (times[after_idx] - times[before_idx])
+            self._derivs = self._lerp(deriv_before, deriv_after, alpha)
+        return self._derivs
+
+    def _temp_index(self, phase):
+        # smoothed temperatures of a phase in sorted order, along with their sample indices
+        index = self._temp_indices.get(phase)
+        if index is None:
+            start_idx, end_idx = self._get_index_range(phase)
+            order = sorted(range(start_idx, end_idx), key=lambda idx: (self.smoothed_samples[idx], idx))
+            index = ([float(self.smoothed_samples[idx]) for idx in order], order)
+            self._temp_indices[phase] = index
+        return index
+
+    def _find_temp(self, temp, phase='cooldown'):
+        # index of the sample closest to temp within the phase, the earliest one on ties
+        temps, order = self._temp_index(phase)
+        best = self._get_index_range(phase)[0]
+        best_error = 100
+        pos = bisect.bisect_left(temps, temp)
+        # closest candidates are the first samples at the value just below and at or above temp
+        candidates = [pos] if pos < len(temps) else []
+        if pos > 0:
+            candidates.append(bisect.bisect_left(temps, temps[pos-1]))
+        for candidate in candidates:
+            error = abs(temps[candidate] - temp)
+            if error < best_error or (error == best_error and error < 100 and order[candidate] < best):
+                best = order[candidate]
+                best_error = error
+        return best
+
+    def calc_params(self, workers=1, method='bisect'):
+        # method: 'bisect' fits one parameter after the other (see _fit_model),
+        #   'joint' fits all of them at once by least squares (see _fit_model_joint)
+        # workers > 1 fits every parameter with a parallel k-ary search over a process pool
+        self.env_temp = self.smoothed_samples[0]
+        if method not in ('bisect', 'joint'):
+            raise ValueError("unknown fitting method %r" % (method,))
+        pool = None
+        if method == 'bisect' and workers > 1:
+            import concurrent.futures
+            pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                    initargs=(self.timestamps, list(self.smoothed_samples), self.pwm_samples))
+        try:
+            if method == 'joint':
+                config = self._fit_model_joint()
+            else:
+                config = self._fit_model(pool, workers)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        # the fitting loop only buffers candidate curves, write them out now that it's over
+        for filename in self.plots.render():
+            logging.info("Autotune: wrote %s", filename)
+        if self.progress is not None:
+            self.progress("deriving steady state offsets")
+        # we need to derive the internal hotend gradients. These are emergent properties,
+        # not model parameters: how far the sensor reads below the average hotend temperature
+        # in equilibrium, relative to the hotend - environment difference. Always written, so a
+        # recalibration replaces the offsets of the previous model in the printer's config
+        tmp_model = model.Model(trace=0, **config)
+        config['steadystate_offset_base'] = tmp_model.steadystate_offset(0.0)
+        config['steadystate_offset_fans'] = tmp_model.steadystate_offset(1.0)
+        return config
+
+    def _cooling_curve(self, phase):
+        temp_range = range(self.calibrate_temp, self._cooldown_target()-1,-1)
+        derivs = self._derivatives()
+        measured_derivs = derivs[[self._find_temp(i, phase) for i in temp_range]]
+        smoothed_derivs = self._smooth(measured_derivs)
+        # we're messing with temperature *differentials* here
+        temp_range = [t - self.env_temp for t in temp_range]
+
+        # poor man's linear regression: pick 2 points, fit to those
+        x1 = temp_range[10]
+        y1 = smoothed_derivs[10]  # the first few will be skewed due to smoothing...
+        x2 = temp_range[-20]
+        y2 = smoothed_derivs[-20]  # as will the last few. The high end of the temperature scale
+        # also sees less cooling since the data came from a moment when the hotend might not have
+        # thermally equalized yet
+
+        a = (y2-y1)/(x2-x1)
+        b = y1 - (a*x1)
+        # cooling is the function a*(t-env_temp)+b
+        return a, b
+
+    def _fit_model(self, pool=None, workers=1):
+        # Order of calibration:
+        #   1. heater strength (initial guess, fit to compensated)
+        #   2. thermal mass (fit to compensated)
+        #   3. base_cooling (fit to smoothed)
+        #   4. heater strength (fit to smoothed)
+
+        heat_start, heat_stop = self._get_index_range('heatup')
+        cool_start, cool_end = self._get_index_range('cooldown')
+        heat_fan_start, heat_fan_stop = self._get_index_range('heatup_fan')
+        cool_fan_start, cool_fan_end = self._get_index_range('cooldown_fan')
+
+        # we'll measure passive convective cooling during the cooldown phase
+        # and compensate our input data for the energy lost.
+        # the resulting temp data allows us to get a good guess at heater power
+        a, b = self._cooling_curve('cooldown')
+        compensated_temps = [self.smoothed_samples[0]]
+        total_loss = 0
+        for idx in range(heat_start+1, cool_end+1):
+            t = self.smoothed_samples[idx]
+            new_temp = max(compensated_temps[-1], t-total_loss)  # preclude occasional modeling errors
+            compensated_temps.append(new_temp)
+            dt = self.timestamps[idx+1] - self.timestamps[idx]
+            loss = dt * (a*(t - self.env_temp) + b)
+            total_loss += loss
+
+        config = {
+            'thermal_conductivity': 0.4,
+            'initial_temp': self.smoothed_samples[heat_start],
+            'env_temp': self.env_temp,
+            'base_cooling': 0.0,
+            'fan_cooling': 0.0
+            }
+
+        # We'll use binary search for every parameter. The following does the lifting for that,
+        # given the initial bounds of the search, the name of the parameter to fit, and a signed error function
+        def binsearch_param(bounds, param, error_fn, start, end, fan_power=0.0):
+            self._begin_stage(param)
+            if pool is not None:
+                return ksearch_param(bounds, param, error_fn, start, end, fan_power)
+            binsrch = bin_search_float(*bounds)
+            curval = next(binsrch)
+            try:
+                while True:
+                    config[param] = curval
+                    model_samples = self._replicate_samples(config, start, end, fan_power)
+                    if self.plots.enabled and param not in ['heater_power', 'thermal_conductivity', 'base_cooling']:
+                        self._plot_candidate(model_samples[start:end], start, end-1, '%s = %f' % (param, curval))
+                    error = error_fn(model_samples)
+                    if error == 0:
+                        break
+                    curval = binsrch.send(TARGET_IS_HIGHER if error > 0 else TARGET_IS_LOWER)
+            except StopIteration:
+                pass
+            return curval
+
+        # Same as binsearch_param, but simulates up to `workers` candidates per round in the process
+        # pool. Ends on the same value, exact hits (error 0) included
+        def ksearch_param(bounds, param, error_fn, start, end, fan_power=0.0):
+            ksrch = kary_search_float(bounds[0], bounds[1], workers)
+            probes = next(ksrch)
+            try:
+                while True:
+                    candidates = [dict(config, **{param: probe}) for probe in probes]
+                    keys = [self._replication_key(cnf, start, end, fan_power) for cnf in candidates]
+                    results = [self._cached_samples(key, start) for key in keys]
+                    missing = [i for i, samples in enumerate(results) if samples is None]
+                    simulated = pool.map(_replicate_in_worker, [candidates[i] for i in missing],
+                            [start] * len(missing), [end] * len(missing), [fan_power] * len(missing))
+                    for i, samples in zip(missing, simulated):
+                        self._store_samples(keys[i], start, samples)
+                        results[i] = samples
+                    feedback = []
+                    for probe, model_samples in zip(probes, results):
+                        if self.plots.enabled and param not in ['heater_power', 'thermal_conductivity', 'base_cooling']:
+                            self._plot_candidate(model_samples[start:end], start, end-1, '%s = %f' % (param, probe))
+                        error = error_fn(model_samples)
+                        if error == 0:
+                            feedback.append(None)
+                        else:
+                            feedback.append(TARGET_IS_HIGHER if error > 0 else TARGET_IS_LOWER)
+                    probes = ksrch.send(feedback)
+            except StopIteration as e:
+                config[param] = e.value
+            return config[param]
+        heater_power = binsearch_param((0,100), 'heater_power',
+                lambda mdl: compensated_temps[cool_end-1] - mdl[cool_end-1], heat_start, cool_end)
+        print('power done')
+
+        # fitting for thermal conductivity
+        fit_pivot = (heat_start + cool_start) // 2
+        def thermal_mass_error(mdl):
+            idx = self._find_temp(mdl[fit_pivot], 'heatup')
+            if fit_pivot == idx:
+                print("found ideal thermal mass")
+            return fit_pivot - idx
+
+        # alternative: sum of errors during heatup, with ramp-up and wind-down being weighted opposite
+        # def thermal_mass_error(mdl):
+        #     error = 0
+        #     for i in range(fit_start, fit_pivot):
+        #         error += mdl[i] - compensated_temps[i]
+        #     for i in range(fit_pivot, fit_end):
+        #         error += compensated_temps[i] - mdl[i]
+        #     return error
+        th_conduct = binsearch_param((0,1.0), 'thermal_conductivity', thermal_mass_error, heat_start, heat_stop)
+        print('conduct done')
+
+        def cooling_error(mdl):
+            # We can't completely isolate cooling and heater_power, since our model of cooling
+            # will be slightly off. We get around this by using our (very) educated guess
+            # of heater power, and compensating for slight scaling misalignment here
+            model_peak = max(*enumerate(mdl), key=lambda s: s[1] if not s[1] is None else 0)
+            scale = self.smoothed_samples[cool_start] / model_peak[1]
+            if scale > 1.3:
+                # too off, try again
+                scale = 1.0
+            error = 0
+            for i in range(cool_start, cool_end):
+                error += mdl[i] * scale - self.smoothed_samples[i]
+            return error
+        cooling = binsearch_param((0,1.0), 'base_cooling', cooling_error, heat_start, cool_end)
+
+        # we're almost done, do one more round of fitting for heater power to vertically align peaks
+        binsearch_param((0,100), 'heater_power', lambda mdl: self.smoothed_samples[cool_start] - mdl[cool_start], heat_start, cool_start)
+        print('old done')
+
+        # TODO tune fan_cooling
+        def fan_cooling_error(mdl):
+            # We can't completely isolate cooling and heater_power, since our model of cooling
+            # will be slightly off. We get around this by using our (very) educated guess
+            # of heater power, and compensating for slight scaling misalignment here
+            model_peak = max(*enumerate(mdl), key=lambda s: s[1] if not s[1] is None else 0)
+            error = 0
+            for i in range(cool_fan_start, cool_fan_end):
+                error += mdl[i] - self.smoothed_samples[i]
+            return error
+        cooling = binsearch_param((0,1.0), 'fan_cooling', fan_cooling_error, heat_fan_start, cool_fan_end, fan_power=1.0)
+
+        msamples = self._replicate_samples(config, heat_start, cool_end, fan_power=0.0)
+        fansamples = self._replicate_samples(config, heat_fan_start, cool_fan_end, fan_power=1.0)
+        self.plots.begin_stage('final')
+        self._plot_candidate(msamples[heat_start:cool_end] + fansamples[heat_fan_start:cool_fan_end], heat_start, cool_fan_end-1)
+
+        return config
+
+    # Parameters fitted by _fit_model_joint, in the order of the sensitivity rows
+    JOINT_PARAMS = ['heater_power', 'thermal_conductivity', 'base_cooling', 'fan_cooling']
+
+    def _replicate_with_sensitivities(self, model_config, start_idx, end_idx, fan_power=0):
+        # Steps the model exactly like _replicate_curve does, and alongside it the derivatives of
+        # every cell with respect to each of JOINT_PARAMS (forward mode: the model is linear in its
+        # state, so each sensitivity row follows the same stencil plus the parameter's own source term).
+        # Returns (sensor temps, jacobian) for samples start_idx+1..end_idx as numpy arrays.
+        import numpy as np
+        cells = int(model_config.get('metal_cells', 6)) + 1
+        passes_per_sec = model_config.get('passes_per_sec', 3)
+        heater_power = model_config['heater_power']
+        env_temp = model_config['env_temp']
+        params = len(self.JOINT_PARAMS)
+        # edge i connects shell i and i+1; the last one is the metal - air boundary
+        conduct = np.full(cells-1, float(model_config['thermal_conductivity']))
+        conduct[-1] = (1.0-fan_power) * model_config['base_cooling'] + fan_power * model_config['fan_cooling']
+        d_conduct = np.zeros((params, cells-1))
+        d_conduct[1, :-1] = 1.0
+        d_conduct[2, -1] = 1.0 - fan_power
+        d_conduct[3, -1] = fan_power
+        # row 0 is the model state, rows 1.. its sensitivities
+        state = np.zeros((params+1, cells))
+        state[0, :] = self.smoothed_samples[start_idx]
+        temps = np.empty(end_idx - start_idx)
+        jacobian = np.empty((end_idx - start_idx, params))
+        time = self.timestamps[start_idx]
+        pwm_idx = 0
+        for tick in range(start_idx+1, end_idx+1):
+            while pwm_idx+1 < len(self.pwm_samples) and self.pwm_samples[pwm_idx+1][0] < time:
+                pwm_idx += 1
+            time = self.timestamps[tick]
+            dt = self.timestamps[tick] - self.timestamps[tick-1]
+            pwm = self.pwm_samples[pwm_idx][1]
+            passes = int(max(1, math.floor(dt * passes_per_sec)))
+            for _ in range(passes):
+                gradient = state[:, 1:] - state[:, :-1]
+                flux = conduct * gradient
+                flux[1:] += d_conduct * gradient[0]
+                temp_diff = np.zeros_like(state)
+                temp_diff[:, 1:] -= flux
+                temp_diff[:, :-1] += flux
+                temp_diff[0, 0] += pwm * heater_power
+                temp_diff[1, 0] += pwm
+                state += (dt / passes) * temp_diff
+                state[0, -1] = env_temp
+                state[1:, -1] = 0.0
+            temps[tick-start_idx-1] = state[0, -2]
+            jacobian[tick-start_idx-1] = state[1:, -2]
+        return temps, jacobian
+
+    def _joint_residuals(self, config, ranges):
+        # residuals (model - smoothed) and their jacobian over all (start, end, fan_power) ranges
+        import numpy as np
+        residuals, jacobians = [], []
+        for start, end, fan_power in ranges:
+            temps, jacobian = self._replicate_with_sensitivities(config, start, end, fan_power)
+            residuals.append(temps - np.asarray(self.smoothed_samples[start+1:end+1], dtype=float))
+            jacobians.append(jacobian)
+        return np.concatenate(residuals), np.concatenate(jacobians)
+
+    def _joint_ranges(self):
+        heat_start, _ = self._get_index_range('heatup')
+        _, cool_end = self._get_index_range('cooldown')
+        heat_fan_start, _ = self._get_index_range('heatup_fan')
+        _, cool_fan_end = self._get_index_range('cooldown_fan')
+        return [(heat_start, cool_end, 0.0), (heat_fan_start, cool_fan_end, 1.0)]
+
+    def fit_residual(self, config):
+        # RMS deviation in degrees of a model config from the smoothed trace, over both heat/cool
+        # cycles; comparable between the 'bisect' and 'joint' fitting methods
+        import numpy as np
+        residuals, _ = self._joint_residuals(config, self._joint_ranges())
+        return float(np.sqrt(residuals.dot(residuals) / len(residuals)))
+
+    def _begin_stage(self, name):
+        self.plots.begin_stage(name)
+        if self.progress is not None:
+            self.progress("fitting %s" % (name,))
+
+    def _fit_model_joint(self, max_iterations=50):
+        # Levenberg-Marquardt on the squared error over both the plain and the fan heat/cool cycle.
+        # Each iteration costs one simulation with sensitivities, instead of one simulation per
+        # bisection step and parameter.
+        import numpy as np
+        self._begin_stage('joint')
+        ranges = self._joint_ranges()
+        heat_start = ranges[0][0]
+        config = {
+            'initial_temp': self.smoothed_samples[heat_start],
+            'env_temp': self.env_temp,
+            # rough guesses: heating rate per cell, and light cooling
+            'heater_power': 10.0,
+            'thermal_conductivity': 0.4,
+            'base_cooling': 0.01,
+            'fan_cooling': 0.01,
+            }
+        theta = np.array([config[p] for p in self.JOINT_PARAMS])
+        # ModelBasedController only accepts conductivities up to 1.0, heater power has no limit
+        upper = np.array([np.inf, 1.0, 1.0, 1.0])
+        residuals, jacobian = self._joint_residuals(config, ranges)
+        loss = residuals.dot(residuals)
+        damping = 1e-3
+        for iteration in range(max_iterations):
+            jtj = jacobian.T.dot(jacobian)
+            jtr = jacobian.T.dot(residuals)
+            step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj) + 1e-12), -jtr)
+            candidate = np.clip(theta + step, 0.0, upper)
+            config.update(zip(self.JOINT_PARAMS, candidate))
+            new_residuals, new_jacobian = self._joint_residuals(config, ranges)
+            new_loss = new_residuals.dot(new_residuals)
+            if new_loss < loss:
+                converged = np.all(np.abs(candidate - theta) < EPSILON * 0.01) or loss - new_loss < 1e-9 * loss
+                theta, residuals, jacobian, loss = candidate, new_residuals, new_jacobian, new_loss
+                damping = max(damping / 10.0, 1e-9)
+                if converged:
+                    break
+            else:
+                damping *= 10.0
+                if damping > 1e9:
+                    break
+        config.update((p, float(v)) for p, v in zip(self.JOINT_PARAMS, theta))
+        message = "joint fit done after %d iterations, rms residual %.3f" % (iteration+1, math.sqrt(loss / len(residuals)))
+        logging.info("Autotune: %s", message)
+        if self.progress is not None:
+            self.progress(message)
+        return config
+
+    def _plot_candidate(self, samples, _from, to, title=None):
+        if not self.plots.enabled:
+            return
+        l = [i for i in range(int(self.pwm_samples[0][0]),int(self.pwm_samples[1][0]))]
+        self.plots.panel(title,
+                ('plot', self.timestamps, self.raw_samples, {'label': 'measured [raw]'}),
+                ('plot', self.timestamps[_from:to+1], samples, {'label': 'model prediction'}),
+                ('bar', l, [200 for _ in l], {'color': "#aaaaaa40", 'width': 1.0, 'label': 'Heater turned on'}))
+
+    def _smooth(self, samples):
+        # The thermistor on my printer has a noise amplitude of about +- 0.4 degrees,
+        # which is higher than some of the derivatives we want to measure, so we'll
+        # need some good smoothing of our data sets
+        from scipy import signal
+        window_length = min(100, max(20, len(samples)//5))
+        if window_length % 2 == 0:
+            window_length += 1
+        return signal.savgol_filter(samples, window_length, 3)
+
+    def _get_index_range(self, phase):
+        start_idx = self.phase_start[phase]
+        end_idx = self.phase_start[ self.phases[self.phases.index(phase)+1] ]
+        return start_idx, end_idx
+
+
+class OfflineHeater:
+    # stand-in heater for analysing recorded traces
+    def get_max_power(self):
+        return 1.0
+
+def get(filename='heattest_200', cache_file=None, plots=None):
+    # cache_file: optional path to persist simulated curves across runs
+    # plots: optional plot_sink.PlotSink receiving the candidate curves
+    c = TraceFit(OfflineHeater(), 200)
+    if plots is not None:
+        c.plots = plots
+    if cache_file is not None:
+        c.replication_cache = ReplicationCache(path=cache_file)
+    c.from_file(filename)
+    return c
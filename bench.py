@@ -0,0 +1,128 @@
+# Benchmarks for the hot paths: model stepping, controller ticks, the simulator and autotuning
+#
+#   python bench.py                        run everything, print JSON results
+#   python bench.py --save baseline.json   ... and store them
+#   python bench.py --compare baseline.json [--tolerance 0.25]
+#                                          exit non-zero if anything got slower than the baseline
+#   python bench.py --only model           run only benchmarks whose name contains 'model'
+
+import contextlib, json, platform, random, sys, time
+import autotune_fit
+import model
+import sim
+
+TRACES = ['heattest_200', 'heattest_fan_200', 'heattest_fan_200_2']
+
+def _timeit(fn, number, repeat):
+    # best of `repeat` runs, in seconds per call
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_model_advance():
+    results = {}
+    for stepping in ('euler', 'exact'):
+        for metal_cells in (3, 6, 12):
+            for passes in (3, 10, 30):
+                if stepping == 'exact' and passes != 3:
+                    continue  # exact stepping doesn't depend on passes_per_sec
+                m = model.Model(20.0, 21.0, 0.2, 0.04, 0.05, 21.0, metal_cells, passes, stepping, trace=0)
+                name = 'model_advance/%s/cells=%d/passes=%d' % (stepping, metal_cells, passes)
+                results[name] = _timeit(lambda: m.advance_model(0.833, 0.5, 0.3), 2000, 5)
+    return results
+
+def bench_controller_update():
+    heater = sim.FakeHeater()
+    controller = sim.ModelBasedController(heater, sim.FakeConfig(sim.DEFAULT_CFG))
+    clock = [0.0]
+    def update():
+        clock[0] += sim.TICK_LEN
+        controller.temperature_update(clock[0], 200.0, 210.0)
+    return {'controller_update': _timeit(update, 5000, 5)}
+
+def bench_sim_ticks():
+    def run():
+        s = sim.Sim(200, rng=random.Random(0))
+        s.ticks(500)
+    def run_batch():
+        s = sim.BatchSim([200] * 100, seed=0)
+        s.ticks(500)
+    # reported per simulated scenario tick
+    return {'sim_tick': _timeit(run, 3, 3) / 500, 'batch_sim_tick/n=100': _timeit(run_batch, 3, 3) / (500 * 100)}
+
+def bench_calc_params():
+    results = {}
+    for trace in TRACES:
+        tune = autotune_fit.get(trace)
+        try:
+            start = time.perf_counter()
+            # keep the fitting progress messages out of the JSON on stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                tune.calc_params()
+            results['calc_params/' + trace] = time.perf_counter() - start
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stderr):
+                tune.calc_params(method='joint')
+            results['calc_params_joint/' + trace] = time.perf_counter() - start
+        except KeyError as e:
+            # the trace doesn't contain all calibration phases
+            results['calc_params/' + trace] = None
+            sys.stderr.write("calc_params/%s: missing phase %s\n" % (trace, e))
+    return results
+
+BENCHMARKS = [bench_model_advance, bench_controller_update, bench_sim_ticks, bench_calc_params]
+
+def run(only=None):
+    results = {}
+    for bench in BENCHMARKS:
+        if only is not None and only not in bench.__name__:
+            continue
+        results.update(bench())
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'unit': 'seconds per call',
+        'results': results,
+        }
+
+def compare(current, baseline, tolerance):
+    # returns the names of benchmarks that got slower by more than tolerance
+    regressions = []
+    for name, seconds in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if seconds is None or before is None:
+            continue
+        ratio = seconds / before
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-45s %12.3g -> %12.3g  x%.2f%s" % (name, before, seconds, ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark model, controller, simulator and autotune")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown before flagging, 0.25 = 25%%")
+    parser.add_argument('--only', help="only run benchmarks whose function name contains this")
+    args = parser.parse_args()
+    current = run(args.only)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        if regressions:
+            sys.exit("slower than baseline: " + ", ".join(regressions))
+    else:
+        print(json.dumps(current, indent=2, sort_keys=True))
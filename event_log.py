@@ -0,0 +1,205 @@
+# Binary log of the live controller's decisions, and offline replay of such logs
+#
+# Enabled per heater with model_event_log: <path>. Each ModelBasedController tick appends a record
+#     read_time, temp, target, fan, pwm, cells[0] ... cells[-1]
+# of float64, after the pwm for that tick has been chosen. The file layout is
+#     magic      8 bytes   b'OHEVLOG1'
+#     header     3 x uint32 (little endian): json length, record width (in float64), reserved
+#     json       controller settings as model_* options without the prefix, plus
+#                heater_max_power, zero-padded to a multiple of 8 bytes
+#     records    float64[width], little endian, until the end of the file
+#
+# A log left over from a previous start (e.g. before the Klipper restart that followed a heater
+# misbehaving) is kept: it is renamed to <path>.1, an older <path>.1 to <path>.2 and so on, and
+# the oldest of EventLog.KEEP previous logs is dropped.
+#
+#   python event_log.py <log>              replay through a fresh controller, compare the pwm
+#   python event_log.py <log> --model      replay through model.Model, report prediction errors
+
+import collections, json, os, struct, sys, threading, time
+from array import array
+
+MAGIC = b'OHEVLOG1'
+HEADER = struct.Struct('<8sIII')
+FIELDS = ('read_time', 'temp', 'target', 'fan', 'pwm')
+
+# Records go into a preallocated array buffer. Full buffers are handed over to the writer thread
+# through a deque (whose append / popleft are atomic, so neither side takes a lock) and come back
+# through another one for reuse. The writer polls, so the reactor never waits on disk or a lock.
+class EventLog(object):
+    KEEP = 5  # previous logs kept next to the current one
+
+    def __init__(self, filename, cells, settings, records_per_buffer=256, interval=0.5):
+        self.width = len(FIELDS) + cells
+        self.records_per_buffer = records_per_buffer
+        self.interval = interval
+        rotate(filename, self.KEEP)
+        self.file = open(filename, 'wb')
+        meta = json.dumps(settings, sort_keys=True).encode('utf-8')
+        meta += b'\0' * (-len(meta) % 8)
+        self.file.write(HEADER.pack(MAGIC, len(meta), self.width, 0))
+        self.file.write(meta)
+        self.full = collections.deque()
+        self.free = collections.deque()
+        self.records = 0
+        self._next_buffer()
+        self.closed = False
+        self.thread = threading.Thread(target=self._write_loop, name='event log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _next_buffer(self):
+        try:
+            self.buffer = self.free.popleft()
+        except IndexError:
+            self.buffer = array('d', bytes(8 * self.width * self.records_per_buffer))
+        self.view = memoryview(self.buffer)
+        self.end = len(self.view)
+        self.offset = 0
+
+    def record(self, read_time, temp, target, fan, pwm, cells):
+        # cells: array('d') or a 'd' memoryview, as held by model.InplaceModel
+        view = self.view
+        offset = self.offset
+        view[offset] = read_time
+        view[offset+1] = temp
+        view[offset+2] = target
+        view[offset+3] = fan
+        view[offset+4] = pwm
+        offset += self.width
+        view[offset-len(cells):offset] = cells
+        self.offset = offset
+        if offset == self.end:
+            self._hand_over()
+
+    def _hand_over(self):
+        self.full.append((self.buffer, self.offset))
+        self.view.release()
+        self._next_buffer()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.offset:
+            self._hand_over()
+        self.closed = True
+        self.thread.join()
+        self.file.close()
+
+    def _write_loop(self):
+        while True:
+            # read before draining, so nothing handed over before close() is missed
+            closed = self.closed
+            while self.full:
+                buf, used = self.full.popleft()
+                data = buf[:used]
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                self.file.write(data.tobytes())
+                self.records += used // self.width
+                self.free.append(buf)
+            self.file.flush()
+            if closed:
+                return
+            time.sleep(self.interval)
+
+def rotate(filename, keep):
+    # shift filename -> filename.1 -> ... -> filename.<keep>, dropping what was filename.<keep>
+    if not os.path.exists(filename):
+        return
+    for i in range(keep, 0, -1):
+        older = '%s.%d' % (filename, i - 1) if i > 1 else filename
+        if os.path.exists(older):
+            os.replace(older, '%s.%d' % (filename, i))
+
+def read(filename):
+    """Map an event log into memory.
+
+    Returns (settings, records), records being a read-only (count, width) numpy memmap with the
+    columns FIELDS followed by the model cells. A record cut short by a crash is ignored.
+    """
+    import numpy as np
+    with open(filename, 'rb') as f:
+        magic, meta_len, width, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a controller event log" % (filename,))
+        settings = json.loads(f.read(meta_len).rstrip(b'\0').decode('utf-8'))
+        f.seek(0, 2)
+        size = f.tell()
+    offset = HEADER.size + meta_len
+    count = (size - offset) // (8 * width)
+    if not count:
+        return settings, np.zeros((0, width))
+    return settings, np.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(count, width))
+
+class _ReplayFan(object):
+    speed = 0.0
+
+    def get_status(self, eventtime):
+        return {'speed': self.speed}
+
+def replay_controller(filename):
+    """Feed a log's measurements through a freshly configured controller.
+
+    Returns (logged pwm, replayed pwm) as lists. Without model_tick_budget (which reacts to
+    the host's timing) a log replays bit for bit.
+    """
+    import sim
+    from model_based_controller import ModelBasedController
+    settings, records = read(filename)
+    heater = sim.FakeHeater()
+    heater.get_max_power = lambda: settings['heater_max_power']
+    cfg = dict((key, val) for key, val in settings.items() if key != 'heater_max_power')
+    controller = ModelBasedController(heater, sim.FakeConfig(cfg))
+    controller.fan = fan = _ReplayFan()
+    replayed = []
+    for read_time, temp, target, fan_speed in records[:, :4].tolist():
+        fan.speed = fan_speed
+        controller.temperature_update(read_time, temp, target)
+        replayed.append(controller.current_heater_pwm)
+    return records[:, 4].tolist(), replayed
+
+def replay_model(filename, **overrides):
+    """Step a model.Model along a log, driven by the logged pwm and fan speeds.
+
+    Unlike the controller, the model is never corrected by the measurements, so this shows how
+    well its settings (optionally changed by overrides, e.g. base_cooling=0.05) predict the
+    hotend. Returns (measured temps, predicted sensor temps) as lists.
+    """
+    import model
+    settings, records = read(filename)
+    settings.update(overrides)
+    m = model.Model(settings['heater_power'], settings['initial_temp'], settings['thermal_conductivity'],
+            settings['base_cooling'], settings['fan_cooling'], settings['env_temp'],
+            settings['metal_cells'], settings['passes_per_sec'], settings['stepping'], trace=0)
+    measured, predicted = [], []
+    last_time, pwm = None, 0.0
+    for read_time, temp, target, fan, next_pwm in records[:, :5].tolist():
+        if last_time is None:
+            # start from the first measurement rather than the configured initial_temp
+            m.cells = [temp] * (len(m.cells)-1) + [m.env_temp]
+        else:
+            m.advance_model(read_time - last_time, pwm, fan)
+        measured.append(temp)
+        predicted.append(m.cells[-2])
+        last_time, pwm = read_time, next_pwm
+    return measured, predicted
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a model-based controller event log")
+    parser.add_argument('log')
+    parser.add_argument('--model', action='store_true', help="replay through model.Model instead of the controller")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.model:
+        measured, predicted = replay_model(args.log)
+        errors = [p - t for t, p in zip(measured, predicted)]
+        summary = "prediction error: mean %.3f, max abs %.3f, final %.3f" % (
+            sum(errors) / max(1, len(errors)), max([abs(e) for e in errors] or [0.0]), (errors or [0.0])[-1])
+    else:
+        logged, replayed = replay_controller(args.log)
+        mismatches = sum(1 for a, b in zip(logged, replayed) if a != b)
+        summary = "pwm mismatches: %d, max difference %.6f" % (
+            mismatches, max([abs(a - b) for a, b in zip(logged, replayed)] or [0.0]))
+    print("%d records replayed in %.3fs, %s" % (len(measured if args.model else logged), time.perf_counter() - start, summary))
@@ -0,0 +1,121 @@
+# Batch calibration of many heater traces, e.g. collected nightly from a fleet of printers
+#
+#   python fleet.py traces/                         fit every trace in traces/, print the results
+#   python fleet.py traces/ --output fleet.json     ... and write them as JSON
+#   python fleet.py traces/ --method joint --workers 8 --store fleet_results
+#
+# Every result is kept in a shelve database keyed by the trace file's content hash, the fitting
+# method and autotune_fit.FITTER_VERSION, so traces that didn't change since the last run are
+# not fitted again. Traces that can't be fitted (e.g. missing calibration phases) are stored too.
+# Files that are neither text nor binary traces are skipped.
+
+import concurrent.futures
+import contextlib, hashlib, json, os, shelve, sys, time
+import autotune_fit
+import trace_file
+
+def find_traces(directory):
+    # every regular, non-hidden file in directory that looks like a text or binary trace
+    paths = (os.path.join(directory, name) for name in os.listdir(directory) if not name.startswith('.'))
+    return sorted(path for path in paths if os.path.isfile(path) and trace_file.is_trace(path))
+
+def trace_digest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def store_key(digest, method):
+    return '%s:%s:%d' % (digest, method, autotune_fit.FITTER_VERSION)
+
+def calibrate(filename, method='bisect'):
+    # runs in a worker process. Returns a JSON-able dict: the model_* settings as written by
+    # MODEL_CALIBRATE, the RMS residual of the fit in degrees and how long it took
+    start = time.perf_counter()
+    try:
+        tune = autotune_fit.get(filename)
+        # keep the fitting progress messages out of the summary on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            config = tune.calc_params(method=method)
+    except Exception as e:
+        # e.g. KeyError: the trace doesn't contain all calibration phases, IndexError: it was cut
+        # short. Reported as the trace's result, so the rest of the run goes on
+        return {'error': '%s: %s' % (type(e).__name__, e), 'seconds': time.perf_counter() - start}
+    return {
+        'settings': dict(('model_' + key, float(val)) for key, val in config.items()),
+        'rms': tune.fit_residual(config),
+        'seconds': time.perf_counter() - start,
+        }
+
+class ResultsStore:
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, result):
+        self.db[key] = result
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+def run(filenames, store, method='bisect', workers=None):
+    """Fit all traces that aren't in the store yet, in parallel.
+
+    Returns {filename: result} for every given trace, with result['cached'] telling whether it
+    came from the store. Results are stored as soon as each fit finishes, so an interrupted run
+    only loses the fits in flight.
+    """
+    results = {}
+    pending = {}
+    for filename in filenames:
+        key = store_key(trace_digest(filename), method)
+        result = store.get(key)
+        if result is not None:
+            results[filename] = dict(result, cached=True)
+        else:
+            pending[filename] = key
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = dict((pool.submit(calibrate, filename, method), filename) for filename in pending)
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                result = future.result()
+                store.put(pending[filename], result)
+                results[filename] = dict(result, cached=False)
+    return results
+
+def summarize(results):
+    lines = []
+    for filename, result in sorted(results.items()):
+        source = 'cached' if result['cached'] else '%.1fs' % (result['seconds'],)
+        if 'error' in result:
+            lines.append("%-30s %8s  failed: %s" % (filename, source, result['error']))
+        else:
+            lines.append("%-30s %8s  rms %.3f  heater_power %.4g  thermal_conductivity %.4g  base_cooling %.4g  fan_cooling %.4g" % (
+                filename, source, result['rms'], result['settings']['model_heater_power'],
+                result['settings']['model_thermal_conductivity'], result['settings']['model_base_cooling'],
+                result['settings']['model_fan_cooling']))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Calibrate the model for every heater trace in a directory")
+    parser.add_argument('directory', help="directory of text or binary heater traces")
+    parser.add_argument('--store', default='fleet_results', help="shelve database of previous results")
+    parser.add_argument('--method', choices=['bisect', 'joint'], default='bisect', help="see TraceFit.calc_params")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', help="write all results to this JSON file")
+    args = parser.parse_args()
+    store = ResultsStore(args.store)
+    try:
+        results = run(find_traces(args.directory), store, args.method, args.workers)
+    finally:
+        store.close()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    print(summarize(results))
@@ -1,9 +1,58 @@
 import math
+import collections
+from array import array
+import plot_sink
 
+# Default for Model(trace=...): when TRACE is set, models keep the last TRACE_CAPACITY ticks
 TRACE = True
+TRACE_CAPACITY = 10000
+
+# Exact stepping: propagators are cached per (dt, fan_power) bucket, see Model._propagator. Building
+# one takes the eigendecomposition of the model's conduction matrix, which is cached per fan_power
+# bucket, so a propagator for a new tick length costs one small matrix product
+DT_QUANTUM = 0.001
+FAN_QUANTUM = 0.01
+PROPAGATOR_CACHE_SIZE = 256
+_propagators = collections.OrderedDict()
+_modes = collections.OrderedDict()
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    if len(cache) > PROPAGATOR_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def _symmetric_eigen(mat):
+    # eigenvalues and eigenvectors (the columns of the returned matrix) of a symmetric matrix, by
+    # cyclic Jacobi rotations. Only ever used on the tiny conduction matrices of the onion model.
+    n = len(mat)
+    a = [list(row) for row in mat]
+    vectors = [[1.0 if i == j else 0.0 for j in range(n)] for i in range(n)]
+    for sweep in range(50):
+        off = sum(a[i][j] * a[i][j] for i in range(n) for j in range(i+1, n))
+        if off <= 1e-30 * sum(a[i][i] * a[i][i] for i in range(n)):
+            break
+        for p in range(n-1):
+            for q in range(p+1, n):
+                if a[p][q] == 0.0:
+                    continue
+                # rotate so that a[p][q] becomes 0
+                theta = (a[q][q] - a[p][p]) / (2.0 * a[p][q])
+                t = (1.0 if theta >= 0.0 else -1.0) / (abs(theta) + math.sqrt(theta * theta + 1.0))
+                c = 1.0 / math.sqrt(t * t + 1.0)
+                s = t * c
+                for k in range(n):
+                    akp, akq = a[k][p], a[k][q]
+                    a[k][p], a[k][q] = c * akp - s * akq, s * akp + c * akq
+                for k in range(n):
+                    apk, aqk = a[p][k], a[q][k]
+                    a[p][k], a[q][k] = c * apk - s * aqk, s * apk + c * aqk
+                for k in range(n):
+                    vkp, vkq = vectors[k][p], vectors[k][q]
+                    vectors[k][p], vectors[k][q] = c * vkp - s * vkq, s * vkp + c * vkq
+    return [a[i][i] for i in range(n)], vectors
 
 class Model(object):
-    def __init__(self, heater_power, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp, metal_cells=6, passes_per_sec=3):
+    def __init__(self, heater_power, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp, metal_cells=6, passes_per_sec=3, stepping='euler', trace=None):
         """Create thermal model of hotend.
 
         heater_power: how many degrees per second the heater can output over the hotend
@@ -11,10 +60,18 @@ class Model(object):
             thermal mass and dissipation speed in the model
         passes_per_sec: minimum number of dissipation passes computed per second. Higher is more accurate
         initial_temp: how hot is the hotend *right now*?
+        stepping: 'euler' runs explicit dissipation passes, 'exact' advances the linear
+            system in closed form with one matrix-vector product per tick (passes_per_sec is ignored)
+        trace: number of ticks of history to keep for plotting, 0 to disable.
+            Defaults to TRACE_CAPACITY if TRACE is set.
         """
+        if stepping not in ('euler', 'exact'):
+            raise ValueError("unknown stepping mode %r" % (stepping,))
         cells = int(metal_cells + 1)  # there's an additional outer shell filled with air
         self.time = 0
         self.passes_per_sec = passes_per_sec
+        self.stepping = stepping
+        self.passes_run = 0  # total dissipation passes computed so far
         self.cells = [initial_temp] * cells
         # Since heat conductivity of metal is pretty high, the heater is effectively outputting
         # the measured degrees per second over *all* cells
@@ -28,9 +85,13 @@ class Model(object):
         self.base_cooling = base_cooling
         self.fan_cooling = fan_cooling
         self.env_temp = env_temp
-        if TRACE:
-            self.history = []
-            self.pwm_history = []
+        if trace is None:
+            trace = TRACE_CAPACITY if TRACE else 0
+        # ring buffer of trace rows, each row is all cells followed by the heater pwm
+        self._trace = array('d', bytes(8 * trace * (cells+1))) if trace else None
+        self.trace_capacity = trace
+        self.trace_len = 0
+        self.trace_head = 0  # row index of the oldest entry once the buffer has wrapped
 
     def config(self):
         return {
@@ -43,15 +104,54 @@ class Model(object):
                 }
 
     def advance_model(self, dt, heater_pwm_until_now, fan_power=0.0):
-        passes = int(max(1, math.floor(dt * self.passes_per_sec)))
-        for _ in range(passes):
-            self.dissipate_temps(dt / passes, heater_pwm_until_now, fan_power)
+        if self.stepping == 'exact':
+            self.propagate_temps(dt, heater_pwm_until_now, fan_power)
+            self.passes_run += 1
+        else:
+            passes = int(max(1, math.floor(dt * self.passes_per_sec)))
+            for _ in range(passes):
+                self.dissipate_temps(dt / passes, heater_pwm_until_now, fan_power)
+            self.passes_run += passes
         self.time += dt
-        if TRACE:
-            self.history.append(list(self.cells))
-            self.pwm_history.append(heater_pwm_until_now)
+        if self._trace is not None:
+            self._record(heater_pwm_until_now)
         return self.cells[-2]
 
+    def _record(self, heater_pwm):
+        width = len(self.cells) + 1
+        row = (self.trace_head + self.trace_len) % self.trace_capacity
+        self._trace[row*width:(row+1)*width - 1] = array('d', self.cells)
+        self._trace[(row+1)*width - 1] = heater_pwm
+        if self.trace_len < self.trace_capacity:
+            self.trace_len += 1
+        else:
+            self.trace_head = (self.trace_head + 1) % self.trace_capacity
+
+    def trace_array(self):
+        """Return the trace buffer as a (capacity, cells+1) numpy view, without copying.
+
+        Rows are in storage order: the oldest row is at trace_head, and only trace_len rows
+        are valid. The last column is the heater pwm.
+        """
+        import numpy as np
+        if self._trace is None:
+            return np.zeros((0, len(self.cells) + 1))
+        return np.frombuffer(self._trace, dtype=np.float64).reshape(self.trace_capacity, len(self.cells) + 1)
+
+    def _trace_rows(self):
+        width = len(self.cells) + 1
+        for i in range(self.trace_len):
+            row = (self.trace_head + i) % self.trace_capacity
+            yield self._trace[row*width:(row+1)*width]
+
+    @property
+    def history(self):
+        return [list(row[:-1]) for row in self._trace_rows()]
+
+    @property
+    def pwm_history(self):
+        return [row[-1] for row in self._trace_rows()]
+
     def adjust_to_measurement(self, sensor_temp):
         if sensor_temp < self.env_temp:
             self.env_temp = sensor_temp
@@ -61,29 +161,88 @@ class Model(object):
         self.cells[-2] -= 1.5*delta
         self.cells[-3] -= 0.7*delta
 
+    def steady_state(self, heater_input, fan_power=0.0, env_temp=None):
+        """Equilibrium temperatures of all cells for a constant heater input.
+
+        heater_input: degrees per second put into the heater shell, i.e. heater_pwm * heater_power
+        env_temp: temperature of the outer air shell, defaults to the model's env_temp
+        Solves the tridiagonal system A * cells = -(heater_input * e_0 + cooling * env_temp * e_last)
+        over the metal shells with the Thomas algorithm. Raises ValueError if some conductivity
+        is 0, there is no finite equilibrium then.
+        """
+        if env_temp is None:
+            env_temp = self.env_temp
+        metal = len(self.cells) - 1
+        # conductivity across the boundary between shell i and shell i+1
+        edges = self._edges(fan_power)
+        if min(edges) <= 0.0:
+            raise ValueError("no steady state without heat flow to the environment")
+        # forward sweep, row i reads edges[i-1] * x[i-1] - (edges[i-1] + edges[i]) * x[i] + edges[i] * x[i+1] = rhs[i]
+        upper = [0.0] * metal
+        rhs = [0.0] * metal
+        for i in range(metal):
+            diag = -edges[i]
+            value = -heater_input if i == 0 else 0.0
+            if i > 0:
+                diag -= edges[i-1]
+                diag -= edges[i-1] * upper[i-1]
+                value -= edges[i-1] * rhs[i-1]
+            if i == metal-1:
+                # the outermost shell is held at environment temp
+                value -= edges[i] * env_temp
+            else:
+                upper[i] = edges[i] / diag
+            rhs[i] = value / diag
+        # back substitution
+        cells = [0.0] * metal + [env_temp]
+        cells[metal-1] = rhs[metal-1]
+        for i in range(metal-2, -1, -1):
+            cells[i] = rhs[i] - upper[i] * cells[i+1]
+        return cells
+
+    def steadystate_offset(self, fan_power=0.0):
+        # In equilibrium the sensor shell reads lower than the average metal temperature, by this
+        # fraction of the (average - env_temp) difference. The system is linear, so the fraction
+        # depends on neither the temperatures nor the heater input.
+        # Without heat flow to the environment (e.g. base_cooling: 0) there's no internal
+        # gradient to compensate for.
+        if min(self._edges(fan_power)) <= 0.0:
+            return 0.0
+        cells = self.steady_state(1.0, fan_power, 0.0)
+        metal = len(cells) - 1
+        avg = sum(cells[:metal]) / metal
+        return 1.0 - cells[metal-1] / avg
+
+    def _edges(self, fan_power):
+        return [self._thermal_conductivity(i, i+1, fan_power) for i in range(len(self.cells)-1)]
+
     def _thermal_conductivity(self, source_idx, target_idx, fan_power):
         if source_idx == len(self.cells)-1 or target_idx == len(self.cells)-1:
             # contact to outside world
             return (1.0-fan_power) * self.base_cooling + fan_power * self.fan_cooling
         return self.thermal_conductivity
 
-    def plot(self):
-        self._plot(self.history, self.pwm_history)
+    def plot(self, sink=None):
+        self._plot(self.history, self.pwm_history, sink)
 
-    def _plot(self, trace, pwm_output):
-        import matplotlib.pyplot as plt
+    def _plot(self, trace, pwm_output, sink=None):
+        # sink: plot_sink.PlotSink to draw to, shows a window right away if not given
+        if sink is None:
+            sink = plot_sink.PlotSink('show')
+        if not sink.enabled:
+            return
         # trace = list of tuples, one for each shell
         shells = len(trace[0])
         time = [ i * 0.833 for i in range(len(trace))]
+        ops = []
         for i in range(shells):
             if i == shells-2:
                 continue
             shell = [blip[i] for blip in trace]
-            plt.plot(time, shell, label='c. shell ' + str(i), linestyle='--')
-        plt.plot(time, [blip[-2] for blip in trace], label='Sensor temp')
-        plt.bar(time, [y * 100 for y in pwm_output], color="#aaaaaa20", width=0.25, label='Heater power')
-        plt.legend(loc='upper left')
-        plt.show()
+            ops.append(('plot', time, shell, {'label': 'c. shell ' + str(i), 'linestyle': '--'}))
+        ops.append(('plot', time, [blip[-2] for blip in trace], {'label': 'Sensor temp'}))
+        ops.append(('bar', time, [y * 100 for y in pwm_output], {'color': "#aaaaaa20", 'width': 0.25, 'label': 'Heater power'}))
+        sink.panel(None, *ops)
 
     def dissipate_temps(self, dt, heater_pwm, fan_power=0.0):
         new_cells = list(self.cells)
@@ -103,3 +262,226 @@ class Model(object):
             # the outermost shell is always at environment temp
             new_cells[-1] = self.env_temp
         self.cells = new_cells
+
+    def _propagator(self, dt, fan_power):
+        # The metal shells form a linear tridiagonal system
+        #     d/dt cells = A * cells + heater_input * e_0 + cooling * env_temp * e_last
+        # with symmetric A = V * diag(l) * V^T. With both inputs constant over a tick, it integrates
+        # exactly to
+        #     cells(dt) = Phi * cells + (heater_input * e_0 + cooling * env_temp * e_last) * G
+        # where Phi = V * diag(exp(l * dt)) * V^T and G = V * diag((exp(l * dt) - 1) / l) * V^T.
+        # Returns (Phi, heater column G * e_0, env column cooling * G * e_last).
+        dt_q = int(round(dt / DT_QUANTUM))
+        fan_q = int(round(fan_power / FAN_QUANTUM))
+        metal = len(self.cells) - 1
+        params = (metal, self.thermal_conductivity, self.base_cooling, self.fan_cooling)
+        key = params + (dt_q, fan_q)
+        cached = _propagators.get(key)
+        if cached is not None:
+            _propagators.move_to_end(key)
+            return cached
+        dt = dt_q * DT_QUANTUM
+        modes = _modes.get(params + (fan_q,))
+        if modes is None:
+            modes = self._modes(fan_q * FAN_QUANTUM)
+            _cache_put(_modes, params + (fan_q,), modes)
+        values, vectors, cooling = modes
+        decay = [math.exp(l * dt) for l in values]
+        # expm1 keeps slow modes accurate, a mode without any decay (no cooling at all) just integrates
+        gain = [math.expm1(l * dt) / l if l != 0.0 else dt for l in values]
+        heater_modes = [g * v for g, v in zip(gain, vectors[0])]
+        env_modes = [cooling * g * v for g, v in zip(gain, vectors[metal-1])]
+        propagator = ([[sum(vi * d * vj for vi, d, vj in zip(row_i, decay, row_j)) for row_j in vectors] for row_i in vectors],
+                [sum(v * h for v, h in zip(row, heater_modes)) for row in vectors],
+                [sum(v * e for v, e in zip(row, env_modes)) for row in vectors])
+        _cache_put(_propagators, key, propagator)
+        return propagator
+
+    def _modes(self, fan_power):
+        # eigendecomposition of the conduction matrix A of the metal shells, and the conductivity to the air
+        metal = len(self.cells) - 1
+        mat = [[0.0] * metal for _ in range(metal)]
+        for target in range(metal):
+            for source in [target-1, target+1]:
+                if source < 0:
+                    continue
+                conductivity = self._thermal_conductivity(source, target, fan_power)
+                mat[target][target] -= conductivity
+                if source < metal:
+                    mat[target][source] += conductivity
+        values, vectors = _symmetric_eigen(mat)
+        return values, vectors, self._thermal_conductivity(metal-1, metal, fan_power)
+
+    def propagate_temps(self, dt, heater_pwm, fan_power=0.0):
+        phi, heater_col, env_col = self._propagator(dt, fan_power)
+        heater_input = heater_pwm * self.heater_power
+        cells = self.cells
+        new_cells = [sum(p * c for p, c in zip(row, cells)) + heater_input * h + self.env_temp * e
+                for row, h, e in zip(phi, heater_col, env_col)]
+        new_cells.append(self.env_temp)
+        self.cells = new_cells
+
+
+class InplaceModel(Model):
+    """Model variant for the live controller path.
+
+    Cells live in a preallocated array('d') that is stepped into a second, equally sized
+    buffer and swapped, instead of building a new list every pass. The arithmetic is the same
+    as Model's, operation for operation, so results are identical. Tracing is off by default.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('trace', 0)
+        Model.__init__(self, *args, **kwargs)
+        self.cells = array('d', self.cells)
+        self._scratch = array('d', self.cells)
+
+    def dissipate_temps(self, dt, heater_pwm, fan_power=0.0):
+        cells = self.cells
+        new_cells = self._scratch
+        last = len(cells) - 1
+        metal = self.thermal_conductivity
+        air = (1.0-fan_power) * self.base_cooling + fan_power * self.fan_cooling
+        # heater shell only has an outer neighbor
+        outer = air if last == 1 else metal
+        new_cells[0] = cells[0] + dt * (outer * (cells[1] - cells[0]) + heater_pwm * self.heater_power)
+        for target in range(1, last):
+            outer = air if target+1 == last else metal
+            new_cells[target] = cells[target] + dt * (metal * (cells[target-1] - cells[target])
+                    + outer * (cells[target+1] - cells[target]))
+        # the outermost shell is always at environment temp
+        new_cells[last] = self.env_temp
+        self.cells, self._scratch = new_cells, cells
+
+    def propagate_temps(self, dt, heater_pwm, fan_power=0.0):
+        phi, heater_col, env_col = self._propagator(dt, fan_power)
+        heater_input = heater_pwm * self.heater_power
+        cells = self.cells
+        new_cells = self._scratch
+        for i in range(len(phi)):
+            new_cells[i] = sum(p * c for p, c in zip(phi[i], cells)) + heater_input * heater_col[i] + self.env_temp * env_col[i]
+        new_cells[len(phi)] = self.env_temp
+        self.cells, self._scratch = new_cells, cells
+
+
+class BatchModel(object):
+    def __init__(self, heater_power, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp, metal_cells=6, passes_per_sec=3, count=None):
+        """Create N thermal models that are stepped in lockstep.
+
+        Takes the same parameters as Model, but heater_power, initial_temp, thermal_conductivity,
+        base_cooling, fan_cooling and env_temp may each be a scalar or a sequence of N values.
+        metal_cells and passes_per_sec are shared by all rows.
+        count: number of rows, only needed if every parameter is a scalar
+        """
+        import numpy as np
+        self.np = np
+        params = [heater_power, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp]
+        if count is None:
+            count = max(np.size(p) for p in params)
+        cells = int(metal_cells + 1)  # there's an additional outer shell filled with air
+        self.time = 0
+        self.passes_per_sec = passes_per_sec
+        self.heater_power = self._row_vector(heater_power, count)
+        self.thermal_conductivity = self._row_vector(thermal_conductivity, count)
+        self.base_cooling = self._row_vector(base_cooling, count)
+        self.fan_cooling = self._row_vector(fan_cooling, count)
+        self.env_temp = self._row_vector(env_temp, count)
+        # one row per model, one column per shell
+        self.cells = np.repeat(self._row_vector(initial_temp, count)[:, None], cells, axis=1)
+
+    @classmethod
+    def from_configs(cls, configs):
+        # configs: list of keyword dicts as accepted by Model, all with the same metal_cells / passes_per_sec
+        keys = ['heater_power', 'initial_temp', 'thermal_conductivity', 'base_cooling', 'fan_cooling', 'env_temp']
+        shared = {}
+        for key, default in (('metal_cells', 6), ('passes_per_sec', 3)):
+            values = set(cnf.get(key, default) for cnf in configs)
+            if len(values) != 1:
+                raise ValueError("BatchModel rows must share %s, got %s" % (key, sorted(values)))
+            shared[key] = values.pop()
+        params = dict((key, [cnf[key] for cnf in configs]) for key in keys)
+        params.update(shared)
+        return cls(count=len(configs), **params)
+
+    def _row_vector(self, value, count):
+        return self.np.array(self.np.broadcast_to(self.np.asarray(value, dtype=float), (count,)))
+
+    def __len__(self):
+        return self.cells.shape[0]
+
+    def config(self, row):
+        return {
+                'heater_power': float(self.heater_power[row]) / (self.cells.shape[1]-1),
+                'metal_cells': self.cells.shape[1]-1,
+                'passes_per_sec': self.passes_per_sec,
+                'thermal_conductivity': float(self.thermal_conductivity[row]),
+                'base_cooling': float(self.base_cooling[row]),
+                'fan_cooling': float(self.fan_cooling[row])
+                }
+
+    def advance_model(self, dt, heater_pwm_until_now, fan_power=0.0):
+        # heater_pwm_until_now and fan_power may be scalars or one value per row
+        passes = int(max(1, math.floor(dt * self.passes_per_sec)))
+        for _ in range(passes):
+            self.dissipate_temps(dt / passes, heater_pwm_until_now, fan_power)
+        self.time += dt
+        # a copy, the cells are stepped in place
+        return self.cells[:, -2].copy()
+
+    def adjust_to_measurement(self, sensor_temp):
+        np = self.np
+        sensor_temp = np.broadcast_to(np.asarray(sensor_temp, dtype=float), self.env_temp.shape)
+        np.minimum(self.env_temp, sensor_temp, out=self.env_temp)
+        delta = self.cells[:, -2] - sensor_temp
+        self.cells[:, -2] -= 1.5*delta
+        self.cells[:, -3] -= 0.7*delta
+
+    def edge_conductivity(self, fan_power=0.0):
+        # conductivity across the boundary between shell i and shell i+1, per row
+        np = self.np
+        fan_power = np.asarray(fan_power, dtype=float)
+        edges = np.repeat(self.thermal_conductivity[:, None], self.cells.shape[1]-1, axis=1)
+        edges[:, -1] = (1.0-fan_power) * self.base_cooling + fan_power * self.fan_cooling
+        return edges
+
+    def steadystate_offset(self, fan_power=0.0):
+        # per row Model.steadystate_offset, with the same arithmetic in the same order
+        # (the env_temp term drops out, it is solved for env_temp = 0)
+        np = self.np
+        edges = self.edge_conductivity(fan_power)
+        # rows without a finite equilibrium get 0, solve them with harmless stand-in values
+        isolated = (edges <= 0.0).any(axis=1)
+        edges[isolated] = 1.0
+        count, metal = edges.shape
+        upper = np.zeros((count, metal))
+        rhs = np.zeros((count, metal))
+        for i in range(metal):
+            diag = -edges[:, i]
+            value = np.full(count, -1.0 if i == 0 else 0.0)
+            if i > 0:
+                diag = diag - edges[:, i-1]
+                diag = diag - edges[:, i-1] * upper[:, i-1]
+                value = value - edges[:, i-1] * rhs[:, i-1]
+            if i < metal-1:
+                upper[:, i] = edges[:, i] / diag
+            rhs[:, i] = value / diag
+        cells = np.zeros((count, metal))
+        cells[:, metal-1] = rhs[:, metal-1]
+        for i in range(metal-2, -1, -1):
+            cells[:, i] = rhs[:, i] - upper[:, i] * cells[:, i+1]
+        avg = cells[:, 0].copy()
+        for i in range(1, metal):
+            avg += cells[:, i]
+        avg /= metal
+        return np.where(isolated, 0.0, 1.0 - cells[:, metal-1] / avg)
+
+    def dissipate_temps(self, dt, heater_pwm, fan_power=0.0):
+        # Same arithmetic as Model.dissipate_temps, in the same order, so results match bit for bit
+        np = self.np
+        flux = self.edge_conductivity(fan_power) * (self.cells[:, 1:] - self.cells[:, :-1])
+        temp_diff = np.zeros_like(self.cells)
+        temp_diff[:, 1:] -= flux
+        temp_diff[:, :-1] += flux
+        temp_diff[:, 0] += np.asarray(heater_pwm, dtype=float) * self.heater_power
+        self.cells += dt * temp_diff
+        # the outermost shell is always at environment temp
+        self.cells[:, -1] = self.env_temp
@@ -1,8 +1,140 @@
-import model
+import math, time
+import event_log, model
 
 def clamp(value, lower, upper):
     return max(lower, min(upper, value))
 
+class TickStats(object):
+    # histogram of time spent in the sections of a control tick, in microseconds
+    BUCKETS_US = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    SECTIONS = ('advance_model', 'adjust_to_measurement', 'pwm', 'total')
+
+    def __init__(self):
+        self.ticks = 0
+        self.passes = 0
+        self.budget_overruns = 0
+        self.histograms = dict((s, [0] * (len(self.BUCKETS_US) + 1)) for s in self.SECTIONS)
+        self.total_us = dict((s, 0.0) for s in self.SECTIONS)
+        self.max_us = dict((s, 0.0) for s in self.SECTIONS)
+
+    def record(self, section, seconds):
+        us = seconds * 1000000.0
+        bucket = 0
+        for limit in self.BUCKETS_US:
+            if us < limit:
+                break
+            bucket += 1
+        self.histograms[section][bucket] += 1
+        self.total_us[section] += us
+        if us > self.max_us[section]:
+            self.max_us[section] = us
+
+    def get_status(self):
+        ticks = max(1, self.ticks)
+        return {
+            'ticks': self.ticks,
+            'passes': self.passes,
+            'budget_overruns': self.budget_overruns,
+            'buckets_us': list(self.BUCKETS_US),
+            'sections': dict((s, {
+                'histogram': list(self.histograms[s]),
+                'avg_us': self.total_us[s] / ticks,
+                'max_us': self.max_us[s],
+                }) for s in self.SECTIONS),
+            }
+
+class ParameterEstimator(object):
+    # Recursive least squares on the controller's model, tracking heater_power, base_cooling and
+    # fan_cooling while it runs. The regressors are the sensitivities of the model's cells to each
+    # parameter, propagated along with the model (the same tridiagonal stencil plus each parameter's
+    # own source term) and through adjust_to_measurement, so a tick costs O(params * cells) per pass
+    # plus O(params^2) for the update, and memory stays fixed.
+    PARAMS = ('heater_power', 'base_cooling', 'fan_cooling')
+    # estimated cooling never reaches 0, the model has no steady state without heat loss
+    COOLING_FLOOR = 0.0001
+
+    def __init__(self, mdl, forgetting=0.999, max_variance=1.0):
+        self.model = mdl
+        self.forgetting = forgetting
+        metal = len(mdl.cells) - 1
+        self.theta = [float(getattr(mdl, p)) for p in self.PARAMS]
+        # relative uncertainty of 50% to start with, cooling may well start out at 0
+        self.max_variance = [max(abs(v), 0.01)**2 * max_variance for v in self.theta]
+        self.covariance = [[0.0] * 3 for _ in range(3)]
+        for i, v in enumerate(self.theta):
+            self.covariance[i][i] = (0.5 * max(abs(v), 0.01))**2
+        # d cells[i] / d theta[p], for the metal shells
+        self.sensitivity = [[0.0] * metal for _ in self.PARAMS]
+        self.last_sensor = None
+        self.updates = 0
+        self.last_residual = 0.0
+
+    def _propagate(self, dt, heater_pwm, fan_power):
+        # one tick of sensitivity dynamics, with the same number of passes as the model's euler stepping
+        mdl = self.model
+        metal = len(self.sensitivity[0])
+        passes = int(max(1, math.floor(dt * mdl.passes_per_sec)))
+        h = dt / passes
+        conduct = mdl.thermal_conductivity
+        air = (1.0-fan_power) * mdl.base_cooling + fan_power * mdl.fan_cooling
+        sensor_start = self.last_sensor
+        sensor_end = mdl.cells[-2]
+        env = mdl.env_temp
+        heater_row, base_row, fan_row = self.sensitivity
+        for j in range(passes):
+            for row in self.sensitivity:
+                flux = [conduct * (row[i+1] - row[i]) for i in range(metal-1)]
+                flux.append(air * (0.0 - row[-1]))
+                row[0] += h * flux[0]
+                for i in range(1, metal):
+                    row[i] += h * (flux[i] - flux[i-1])
+            # the sensor shell is the one exchanging heat with the air
+            sensor = sensor_start + (sensor_end - sensor_start) * j / passes
+            heater_row[0] += h * heater_pwm
+            base_row[-1] += h * (1.0-fan_power) * (env - sensor)
+            fan_row[-1] += h * fan_power * (env - sensor)
+
+    def update(self, dt, heater_pwm, fan_power, sensor_temp):
+        # call after the model was advanced, before adjust_to_measurement
+        mdl = self.model
+        if self.last_sensor is not None:
+            self._propagate(dt, heater_pwm, fan_power)
+            phi = [row[-1] for row in self.sensitivity]
+            residual = sensor_temp - mdl.cells[-2]
+            cov = self.covariance
+            cov_phi = [sum(cov[i][j] * phi[j] for j in range(3)) for i in range(3)]
+            denom = self.forgetting + sum(phi[i] * cov_phi[i] for i in range(3))
+            gain = [c / denom for c in cov_phi]
+            for i in range(3):
+                self.theta[i] += gain[i] * residual
+                for j in range(3):
+                    cov[i][j] = (cov[i][j] - gain[i] * cov_phi[j]) / self.forgetting
+                # keep the covariance from winding up while there's nothing to learn from
+                if cov[i][i] > self.max_variance[i]:
+                    scale = math.sqrt(self.max_variance[i] / cov[i][i])
+                    for j in range(3):
+                        cov[i][j] *= scale
+                        cov[j][i] *= scale
+            self.theta[0] = max(self.theta[0], 0.01)
+            self.theta[1] = clamp(self.theta[1], self.COOLING_FLOOR, 1.0)
+            self.theta[2] = clamp(self.theta[2], self.COOLING_FLOOR, 1.0)
+            for name, value in zip(self.PARAMS, self.theta):
+                setattr(mdl, name, value)
+            self.updates += 1
+            self.last_residual = residual
+        # adjust_to_measurement moves the sensor shell and its neighbour, carry that over
+        for row in self.sensitivity:
+            sensor = row[-1]
+            row[-1] -= 1.5 * sensor
+            row[-2] -= 0.7 * sensor
+        self.last_sensor = mdl.cells[-2] - 1.5 * (mdl.cells[-2] - sensor_temp)
+
+    def get_status(self):
+        status = dict(zip(self.PARAMS, self.theta))
+        status['updates'] = self.updates
+        status['residual'] = self.last_residual
+        return status
+
 class ModelBasedController(object):
     # internally models hotend as made of cells of metal surrounded by air
     # heater is in innermost shell (0), sensor in outermost metal shell
@@ -20,6 +152,8 @@ class ModelBasedController(object):
         metal_cells = config.getint('model_metal_cells', 6, minval=2)
         # minimum number of simulation passes per second
         passes_per_sec = config.getint('model_passes_per_sec', 3)
+        # 'euler' runs passes_per_sec explicit passes, 'exact' steps the model in closed form
+        stepping = config.getchoice('model_stepping', {'euler': 'euler', 'exact': 'exact'}, 'euler')
         # heat dissipation rate within metal
         thermal_conductivity = config.getfloat('model_thermal_conductivity', minval=0.0, maxval=1.0)
         # heat - air dissipation rate
@@ -28,18 +162,62 @@ class ModelBasedController(object):
         # TODO get rid of initial_temp and env_temp
         initial_temp = config.getfloat('model_initial_temp', 21.4, minval=0.0)
         env_temp = config.getfloat('model_env_temp', 21.4, minval=0.0)
-        self.internal_gradients = config.getfloat('model_steadystate_offset_base', 0.0), config.getfloat('model_steadystate_offset_fans', 0.0)
+        # Steady state offsets at fan power 0 / 1, as written by MODEL_CALIBRATE. The offset is lerped
+        # between the two; without them it is derived from the model for any fan power
+        self.offset_overrides = (config.getfloat('model_steadystate_offset_base', None),
+                config.getfloat('model_steadystate_offset_fans', None))
 
-        self.model = model.Model(self.heater_output, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp, metal_cells, passes_per_sec)
+        # if a tick takes longer than this many seconds, run fewer passes per second until it doesn't (0 = off)
+        self.tick_budget = config.getfloat('model_tick_budget', 0.0, minval=0.0)
+
+        self.model = model.InplaceModel(self.heater_output, initial_temp, thermal_conductivity, base_cooling, fan_cooling, env_temp, metal_cells, passes_per_sec, stepping)
+        self.passes_per_sec = passes_per_sec
+        self.stats = TickStats()
+        # track heater_power, base_cooling and fan_cooling while running, see ParameterEstimator
+        self.estimator = None
+        estimate = config.getboolean('model_estimate', False)
+        forgetting = config.getfloat('model_estimate_forgetting', 0.999, minval=0.9, maxval=1.0)
+        if estimate:
+            if stepping == 'exact':
+                # every new estimate would need a new propagator (see model.Model._propagator),
+                # and the sensitivities follow the euler passes anyway
+                raise config.error("model_estimate can't be combined with model_stepping: exact")
+            self.estimator = ParameterEstimator(self.model, forgetting)
+        # opt-in binary log of every tick, see event_log
+        self.event_log = None
+        event_log_path = config.get('model_event_log', None)
+        if event_log_path is not None:
+            settings = {'heater_power': self.heater_output, 'metal_cells': metal_cells, 'passes_per_sec': passes_per_sec,
+                    'stepping': stepping, 'thermal_conductivity': thermal_conductivity, 'base_cooling': base_cooling,
+                    'fan_cooling': fan_cooling, 'initial_temp': initial_temp, 'env_temp': env_temp,
+                    'tick_budget': self.tick_budget, 'estimate': estimate, 'estimate_forgetting': forgetting,
+                    'heater_max_power': self.heater_max_power}
+            for key, value in zip(('steadystate_offset_base', 'steadystate_offset_fans'), self.offset_overrides):
+                if value is not None:
+                    settings[key] = value
+            self.event_log = event_log.EventLog(event_log_path, len(self.model.cells), settings)
+            # write out what's still buffered when Klipper shuts down
+            config.get_printer().register_event_handler('klippy:disconnect', self.event_log.close)
         self.current_heater_pwm = 0.0
-        # we keep a tally of how long on avg a control tick lasts
-        self.last_read_times = [-4, -3, -2, -1]
+        self._offset_key = self._offset_gradient = None
+        # we keep a tally of how long on avg a control tick lasts, over the last 4 read times
+        self._read_time_0, self._read_time_1, self._read_time_2, self._read_time_3 = -4, -3, -2, -1
+
+    @property
+    def last_read_times(self):
+        return [self._read_time_0, self._read_time_1, self._read_time_2, self._read_time_3]
 
     def stable_state_offset(self, target_temp, fan_power):
         # internal gradients require us to target a higher temperature, which in turn
         # increases the internal gradient! Since the internal gradients in an autotuned
         # model can get quite big, we need to solve this correctly.
-        effective_gradient = fan_power * self.internal_gradients[1] + (1-fan_power) * self.internal_gradients[0]
+        m = self.model
+        key = (fan_power, m.thermal_conductivity, m.base_cooling, m.fan_cooling)
+        if key != self._offset_key:
+            # only changes with the fan speed, no need to solve for it every tick
+            self._offset_key = key
+            self._offset_gradient = self._effective_gradient(fan_power)
+        effective_gradient = self._offset_gradient
 
         # we have
         #     orig_trg = new_trg - (new_trg - env_temp) * gradient
@@ -48,27 +226,81 @@ class ModelBasedController(object):
         return (target_temp - self.model.env_temp * effective_gradient) / (1 - effective_gradient) - target_temp
 
 
+    def _effective_gradient(self, fan_power):
+        base, fans = self.offset_overrides
+        if base is None and fans is None:
+            return self.model.steadystate_offset(fan_power)
+        if base is None:
+            base = self.model.steadystate_offset(0.0)
+        if fans is None:
+            fans = self.model.steadystate_offset(1.0)
+        return fan_power * fans + (1-fan_power) * base
+
     def temperature_update(self, read_time, temp, target_temp):
         fan_power = self.fan.get_status(None)['speed']
-        self.model.advance_model(read_time - self.last_read_times[-1], self.current_heater_pwm, fan_power)
+        dt = read_time - self._read_time_3
+        passes_before = self.model.passes_run
+        start = time.perf_counter()
+        self.model.advance_model(dt, self.current_heater_pwm, fan_power)
+        advanced = time.perf_counter()
+        if self.estimator is not None:
+            self.estimator.update(dt, self.current_heater_pwm, fan_power, temp)
+            self.heater_output = self.model.heater_power
         self.model.adjust_to_measurement(temp)
+        adjusted = time.perf_counter()
 
         # TODO: Is this really needed?
-        self.last_read_times.append(read_time)
-        self.last_read_times = self.last_read_times[1:]
-        tick_lens = [self.last_read_times[i] - self.last_read_times[i-1] for i in range(1, len(self.last_read_times))]
-        tick_len = sum(tick_lens) / len(tick_lens)
+        self._read_time_0 = self._read_time_1
+        self._read_time_1 = self._read_time_2
+        self._read_time_2 = self._read_time_3
+        self._read_time_3 = read_time
+        tick_len = ((self._read_time_1 - self._read_time_0) + (self._read_time_2 - self._read_time_1)
+                + (self._read_time_3 - self._read_time_2)) / 3
 
         # now calculate how much heat we still need to dump into the hotend
-        model_avg_temp = sum(self.model.cells[:-1]) / (len(self.model.cells)-1)
+        cells = self.model.cells
+        metal_cells = len(cells)-1
+        model_sum = 0
+        for i in range(metal_cells):
+            model_sum += cells[i]
+        model_avg_temp = model_sum / metal_cells
         degrees_needed = (target_temp - model_avg_temp \
                 # since we're constantly losing heat, there is always an internal gradient in the hotend.
                 # if we don't compensate for this, we'll have a steady state error
                 + self.stable_state_offset(target_temp, fan_power)  \
-                ) * (len(self.model.cells)-1)
+                ) * metal_cells
         # if the expected tick length is long, we need less heat
         self.current_heater_pwm = clamp(degrees_needed / (self.heater_output * tick_len), 0.0, self.heater_max_power)
+        end = time.perf_counter()
+        self._record_tick(start, advanced, adjusted, end, self.model.passes_run - passes_before)
         self.heater.set_pwm(read_time, self.current_heater_pwm)
+        if self.event_log is not None:
+            self.event_log.record(read_time, temp, target_temp, fan_power, self.current_heater_pwm, self.model.cells)
+
+    def _record_tick(self, start, advanced, adjusted, end, passes):
+        stats = self.stats
+        stats.ticks += 1
+        stats.passes += passes
+        stats.record('advance_model', advanced - start)
+        stats.record('adjust_to_measurement', adjusted - advanced)
+        stats.record('pwm', end - adjusted)
+        stats.record('total', end - start)
+        if not self.tick_budget:
+            return
+        # budget mode: halve the sub-steps on overrun, creep back up once there's plenty of headroom
+        if end - start > self.tick_budget:
+            stats.budget_overruns += 1
+            self.model.passes_per_sec = max(1, self.model.passes_per_sec // 2)
+        elif end - start < self.tick_budget / 4 and self.model.passes_per_sec < self.passes_per_sec:
+            self.model.passes_per_sec += 1
+
+    def get_status(self, eventtime):
+        status = self.stats.get_status()
+        status['passes_per_sec'] = self.model.passes_per_sec
+        status['heater_pwm'] = self.current_heater_pwm
+        if self.estimator is not None:
+            status['estimates'] = self.estimator.get_status()
+        return status
 
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         return abs(smoothed_temp - target_temp) > 7
@@ -0,0 +1,70 @@
+# Destination for the graphs drawn by the simulator, the model and the autotuner
+#
+# Modes:
+#   off:    drop everything, never imports matplotlib (default for the autotuner)
+#   record: keep the panels in memory, grouped by stage
+#   render: like record, but render() writes one multi-panel image per stage
+#   show:   draw every panel in a blocking matplotlib window right away
+
+import collections, math, os
+
+MODES = ('off', 'record', 'render', 'show')
+
+class PlotSink(object):
+    def __init__(self, mode='off', directory='.', fmt='png', prefix='plot'):
+        if mode not in MODES:
+            raise ValueError("unknown plot mode %r, expected one of %s" % (mode, ', '.join(MODES)))
+        self.mode = mode
+        self.directory = directory
+        self.fmt = fmt
+        self.prefix = prefix
+        self.stages = collections.OrderedDict()
+        self.stage = 'default'
+
+    @property
+    def enabled(self):
+        # callers should check this before assembling data for a panel
+        return self.mode != 'off'
+
+    def begin_stage(self, name):
+        self.stage = name
+
+    def panel(self, title, *ops):
+        """Add a panel made of drawing operations.
+
+        Each op is a tuple (kind, x, y, kwargs) with kind being 'plot' or 'bar', passed
+        on to the matplotlib axes method of the same name.
+        """
+        if self.mode == 'off':
+            return
+        if self.mode == 'show':
+            import matplotlib.pyplot as plt
+            self._draw(plt.gca(), title, ops)
+            plt.show()
+            return
+        self.stages.setdefault(self.stage, []).append((title, ops))
+
+    def render(self):
+        # writes one file per recorded stage and returns their names
+        if self.mode != 'render':
+            return []
+        from matplotlib.figure import Figure
+        written = []
+        for stage, panels in self.stages.items():
+            cols = int(math.ceil(math.sqrt(len(panels))))
+            rows = int(math.ceil(len(panels) / float(cols)))
+            fig = Figure(figsize=(6 * cols, 4 * rows))
+            for i, (title, ops) in enumerate(panels):
+                self._draw(fig.add_subplot(rows, cols, i+1), title, ops)
+            filename = os.path.join(self.directory, '%s_%s.%s' % (self.prefix, stage, self.fmt))
+            fig.savefig(filename)
+            written.append(filename)
+        self.stages.clear()
+        return written
+
+    def _draw(self, axes, title, ops):
+        for kind, x, y, kwargs in ops:
+            getattr(axes, kind)(x, y, **kwargs)
+        if title:
+            axes.set_title(title)
+        axes.legend(loc='upper left')
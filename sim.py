@@ -1,7 +1,10 @@
 
 import random
 import math
+import heapq, itertools
 from model_based_controller import ModelBasedController
+import model
+import plot_sink
 
 class FakeHeater(object):
     def __init__(self):
@@ -16,19 +19,32 @@ class FakeHeater(object):
     def set_pwm(self, time, value):
         self.pwm = value
 
+    def get_pwm_delay(self):
+        return 0.0
+
+    def alter_target(self, target_temp):
+        pass
+
 class FakeConfig(object):
+    error = ValueError
+
     def __init__(self, model_config):
         self.cfg = model_config
+        self.printer = FakeConfig.FakePrinter()
 
     class FakePrinter(object):
         def get_status(self, none):
             return {'speed': 0.0}
 
         def lookup_object(self, string):
+            # stands in for the fan
             return self
 
+        def register_event_handler(self, event, callback):
+            pass
+
     def get_printer(self):
-        return FakeConfig.FakePrinter()
+        return self.printer
 
     def getfloat(self, string, *args, **kwargs):
         assert string.startswith('model_')
@@ -38,9 +54,18 @@ class FakeConfig(object):
         assert len(args)
         return args[0]
 
+    def get(self, string, *args, **kwargs):
+        return self.getfloat(string, *args, **kwargs)
+
     def getint(self, string, *args, **kwargs):
         return self.getfloat(string, *args, **kwargs)
 
+    def getchoice(self, string, choices, *args, **kwargs):
+        return choices[self.getfloat(string, *args, **kwargs)]
+
+    def getboolean(self, string, *args, **kwargs):
+        return bool(self.getfloat(string, *args, **kwargs))
+
 TICK_LEN = 0.833
 ENV_TEMP = 21
 HEATER_POWER = 2.0166
@@ -52,11 +77,42 @@ DEFAULT_CFG = {
         'heater_power': HEATER_POWER,
         'thermal_conductivity': HEAT_CONDUCT_METAL,
         'base_cooling': HEAT_CONDUCT_AIR,
-        'initial_temp': ENV_TEMP
+        'initial_temp': ENV_TEMP,
+        # the simulated hotend isn't the controller's model, keep targeting the plain setpoint
+        'steadystate_offset_base': 0.0,
+        'steadystate_offset_fans': 0.0,
         }
 
+def _S(x):
+    return 1 / (1 + math.exp(-x))
+
+def _bell(x):
+    if x < 0:
+        return _S(x*2+6)
+    return _S(-x*2+6)
+
+def disturbance_profile(degrees, duration):
+    # soft disturbance, ramping in and out over 6 ticks each
+    def disturbance(tick):
+        if tick < 6:
+            return degrees * _bell(tick-6)
+        if tick >= duration-6:
+            return degrees * _bell(6 - duration + tick)
+        return degrees
+    return [disturbance(i) for i in range(duration)]
+
+def read_disturbances(filename):
+    # yields (tick, degrees) pairs from a text file, skipping blank lines and # comments
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                tick, degrees = line.split()
+                yield int(tick), float(degrees)
+
 class Sim(object):
-    def __init__(self, target, metal_cells=5, power=HEATER_POWER, randomness=NOISE_AMP, dissipation_passes=2, model_cfg=DEFAULT_CFG):
+    def __init__(self, target, metal_cells=5, power=HEATER_POWER, randomness=NOISE_AMP, dissipation_passes=2, model_cfg=DEFAULT_CFG, rng=None):
+        # rng: random.Random to draw noise from, defaults to the global random module
         cells = int(metal_cells + 1)  # one filled with air
         self.target = target
         self.power = power
@@ -70,34 +126,44 @@ class Sim(object):
         for i in range(len(self.controller.model.cells)):
             self.controller_data.append(list([0.0]))
         self.controller_decisions = [0.0]
-        self.modifications_todo = []
+        # pending disturbances as a heap of (absolute tick, sequence number, value, source iterator)
+        self.disturbances = []
+        self._disturbance_seq = itertools.count()
+        self.tick_count = 0
         self.randomness = randomness
+        self.rng = rng if rng is not None else random
         self.time = 0
 
     def _noise(self):
-        return random.random() * self.randomness - 0.5 * self.randomness
-
-    def _S(self, x):
-        return 1 / (1 + math.exp(-x))
+        return self.rng.random() * self.randomness - 0.5 * self.randomness
 
-    def _bell(self,x):
-        if x < 0:
-            return self._S(x*2+6)
-        return self._S(-x*2+6)
+    def _schedule(self, tick, value, source=None):
+        heapq.heappush(self.disturbances, (tick, next(self._disturbance_seq), value, source))
 
     def disturb(self, degrees=-4, in_ticks=10, duration=20):
-        def disturbance(tick):
-            if tick < 6:
-                return degrees * self._bell(tick-6)
-            if tick >= duration-6:
-                return degrees * self._bell(6 - duration + tick)
-            return degrees
-        self.modifications_todo += [(in_ticks + i, disturbance(i) + self._noise()) for i in range(duration)]
-        self.modifications_todo.sort(key=lambda mod: mod[0])
+        for i, value in enumerate(disturbance_profile(degrees, duration)):
+            self._schedule(self.tick_count + in_ticks + i, value + self._noise())
 
     def disturb_hard(self, degrees=-4, in_ticks=10, duration=20):
-        self.modifications_todo += [(in_ticks + i, degrees + self._noise()) for i in range(duration)]
-        self.modifications_todo.sort(key=lambda mod: mod[0])
+        for i in range(duration):
+            self._schedule(self.tick_count + in_ticks + i, degrees + self._noise())
+
+    def load_disturbances(self, schedule, in_ticks=0):
+        """Add a disturbance schedule, e.g. a filament extrusion heat loss profile.
+
+        schedule: a filename with one "<tick> <degrees>" pair per line, or an iterable
+            (possibly a generator) of (tick, degrees) pairs, in ascending tick order.
+            Ticks are relative to in_ticks from now. Iterables are consumed lazily as
+            the simulation reaches them, so arbitrarily long schedules are fine.
+        """
+        if isinstance(schedule, str):
+            schedule = read_disturbances(schedule)
+        self._schedule_next(iter(schedule), self.tick_count + in_ticks)
+
+    def _schedule_next(self, source, offset):
+        for tick, value in source:
+            self._schedule(offset + int(tick), float(value), (source, offset))
+            return
 
     def dissipate_temps(self, env_cooling_factor=1.0):
         # heat dissipation as cellular automaton: each shell independently calculates how much
@@ -119,16 +185,14 @@ class Sim(object):
 
 
     def _pop_disturbance(self):
+        # sums up all disturbances due this tick, and advances the tick counter
         mod = 0
-        occurred = 0
-        for i in range(len(self.modifications_todo)):
-            time_left, until_mod = self.modifications_todo[i]
-            if time_left == 0:
-                mod += until_mod
-                occurred += 1
-            else:
-                self.modifications_todo[i] = (time_left - 1, until_mod)
-        self.modifications_todo = self.modifications_todo[occurred:]
+        while self.disturbances and self.disturbances[0][0] <= self.tick_count:
+            _, _, value, source = heapq.heappop(self.disturbances)
+            mod += value
+            if source is not None:
+                self._schedule_next(*source)
+        self.tick_count += 1
         return mod
 
     def tick(self):
@@ -149,21 +213,25 @@ class Sim(object):
         for _ in range(n):
             self.tick()
 
-    def plot(self):
-        import matplotlib.pyplot as plt
+    def plot(self, sink=None):
+        # sink: plot_sink.PlotSink to draw to, shows a window right away if not given
+        if sink is None:
+            sink = plot_sink.PlotSink('show')
+        if not sink.enabled:
+            return
         time = [ i * TICK_LEN for i in range(len(self.controller_data[0]))]
+        ops = []
         for i, shell in enumerate(self.controller_data):
-            plt.plot(time, shell, label='c. shell ' + str(i), linestyle='--')
-        plt.plot(time, self.temperature_history, label='Simulator temp')
-        plt.bar(time, [y * 100 for y in self.controller_decisions], color="#aaaaaa20", width=0.25, label='Heater power')
-        plt.legend(loc='upper left')
-        plt.show()
+            ops.append(('plot', time, shell, {'label': 'c. shell ' + str(i), 'linestyle': '--'}))
+        ops.append(('plot', time, self.temperature_history, {'label': 'Simulator temp'}))
+        ops.append(('bar', time, [y * 100 for y in self.controller_decisions], {'color': "#aaaaaa20", 'width': 0.25, 'label': 'Heater power'}))
+        sink.panel(None, *ops)
 
     def sensor_temp(self):
         return self.temp_cells[-2]
 
 class NullSim(Sim):
-    def __init__(self, target, config=DEFAULT_CFG, randomness=NOISE_AMP):
+    def __init__(self, target, config=DEFAULT_CFG, randomness=NOISE_AMP, rng=None):
         self.target = target
         self.config = config
         self.heater = FakeHeater()
@@ -174,8 +242,12 @@ class NullSim(Sim):
         for i in range(len(self.controller.model.cells)):
             self.controller_data.append(list([0.0]))
         self.controller_decisions = [0.0]
-        self.modifications_todo = []
+        # pending disturbances as a heap of (absolute tick, sequence number, value, source iterator)
+        self.disturbances = []
+        self._disturbance_seq = itertools.count()
+        self.tick_count = 0
         self.randomness = randomness
+        self.rng = rng if rng is not None else random
         self.time = 0
 
     def sensor_temp(self):
@@ -195,3 +267,149 @@ class NullSim(Sim):
         for i in range(len(cont.model.cells)):
             self.controller_data[i].append(cont.model.cells[i])
         self.time += TICK_LEN
+
+
+class BatchSim(object):
+    def __init__(self, targets, metal_cells=5, power=HEATER_POWER, randomness=NOISE_AMP, model_cfgs=None, rngs=None, seed=None):
+        """Simulate len(targets) plants and controllers as arrays, advanced in lockstep.
+
+        power and randomness may be scalars or one value per scenario.
+        model_cfgs: one controller model config per scenario, defaults to DEFAULT_CFG. All of them
+            must have the same metal_cells and passes_per_sec, euler stepping and neither estimate nor
+            tick_budget set (ValueError otherwise)
+        rngs: one random.Random per scenario. Noise is then drawn exactly like Sim(rng=...) does,
+            so results match the scalar Sim. Otherwise noise comes from numpy, seeded with seed.
+        """
+        import numpy as np
+        self.np = np
+        count = len(targets)
+        self.count = count
+        self.target = np.array(targets, dtype=float)
+        self.power = np.array(np.broadcast_to(np.asarray(power, dtype=float), (count,)))
+        self.randomness = np.array(np.broadcast_to(np.asarray(randomness, dtype=float), (count,)))
+        if model_cfgs is None:
+            model_cfgs = [DEFAULT_CFG] * count
+        # let the real controller parse the configs, so defaults can't drift apart
+        controllers = [ModelBasedController(FakeHeater(), FakeConfig(cfg)) for cfg in model_cfgs]
+        models = [c.model for c in controllers]
+        # BatchModel shares one shell layout and pass count between all rows, and only steps Euler
+        for name, values in (('metal_cells', set(len(m.cells)-1 for m in models)),
+                ('passes_per_sec', set(m.passes_per_sec for m in models))):
+            if len(values) != 1:
+                raise ValueError("BatchSim model configs must share %s, got %s" % (name, sorted(values)))
+        if any(m.stepping != 'euler' for m in models):
+            raise ValueError("BatchSim only supports model_stepping: euler")
+        # nor does it mirror the controller's online estimation or tick budget
+        if any(c.estimator is not None or c.tick_budget for c in controllers):
+            raise ValueError("BatchSim doesn't support model_estimate or model_tick_budget")
+        self.model = model.BatchModel(
+                [m.heater_power for m in models], [m.cells[0] for m in models],
+                [m.thermal_conductivity for m in models], [m.base_cooling for m in models],
+                [m.fan_cooling for m in models], [m.env_temp for m in models],
+                len(models[0].cells)-1, models[0].passes_per_sec, count)
+        self.heater_output = np.array([c.heater_output for c in controllers])
+        self.heater_max_power = np.array([c.heater_max_power for c in controllers])
+        # explicit steady state offsets per row, nan where the model's own offset is used
+        self.offset_overrides = np.array([[np.nan if v is None else v for v in c.offset_overrides]
+                for c in controllers], dtype=float)
+        self.fan_power = np.zeros(count)
+        self.current_heater_pwm = np.zeros(count)
+        self.last_read_times = [-4, -3, -2, -1]
+        # heater is at first (innermost) shell, sensor at second-to-last shell, outermost shell is outside
+        self.temp_cells = np.full((count, int(metal_cells + 1)), float(ENV_TEMP))
+        self.rngs = rngs
+        self.np_rng = np.random.default_rng(seed)
+        # pending disturbances: absolute tick -> per scenario offset
+        self.disturbances = {}
+        self.tick_count = 0
+        self.time = 0
+        self.temperature_history = []
+        self.controller_decisions = []
+
+    def _noise(self, rows=None):
+        if self.rngs is None:
+            amp = self.randomness if rows is None else self.randomness[rows]
+            return self.np_rng.random(amp.shape) * amp - 0.5 * amp
+        rows = range(self.count) if rows is None else rows
+        return self.np.array([self.rngs[r].random() * self.randomness[r] - 0.5 * self.randomness[r] for r in rows])
+
+    def _add_disturbance(self, row, in_ticks, values):
+        # values are drawn one at a time so per scenario rngs are consumed in the same order as in Sim
+        for i, value in enumerate(values):
+            offsets = self.disturbances.setdefault(self.tick_count + in_ticks + i, self.np.zeros(self.count))
+            offsets[row] += value + float(self._noise([row])[0])
+
+    def disturb(self, row, degrees=-4, in_ticks=10, duration=20):
+        self._add_disturbance(row, in_ticks, disturbance_profile(degrees, duration))
+
+    def disturb_hard(self, row, degrees=-4, in_ticks=10, duration=20):
+        self._add_disturbance(row, in_ticks, [degrees] * duration)
+
+    def dissipate_temps(self, env_cooling_factor=1.0):
+        # same arithmetic as Sim.dissipate_temps, for all scenarios at once
+        cells = self.temp_cells
+        conduct = self.np.full(cells.shape[1]-1, HEAT_CONDUCT_METAL)
+        conduct[-1] = env_cooling_factor * HEAT_CONDUCT_AIR
+        flow = conduct * (cells[:, :-1] - cells[:, 1:])
+        next_cells = cells.copy()
+        next_cells[:, 1:] += flow
+        next_cells[:, :-1] -= flow
+        next_cells[:, -1] = ENV_TEMP
+        self.temp_cells = next_cells
+
+    def stable_state_offset(self, target_temp, fan_power):
+        # array version of ModelBasedController.stable_state_offset
+        np = self.np
+        effective_gradient = self.model.steadystate_offset(fan_power)
+        base, fans = self.offset_overrides[:, 0], self.offset_overrides[:, 1]
+        overridden = ~(np.isnan(base) & np.isnan(fans))
+        if overridden.any():
+            # same as ModelBasedController._effective_gradient
+            base = np.where(np.isnan(base), self.model.steadystate_offset(0.0), base)
+            fans = np.where(np.isnan(fans), self.model.steadystate_offset(1.0), fans)
+            effective_gradient = np.where(overridden, fan_power * fans + (1-fan_power) * base, effective_gradient)
+        return (target_temp - self.model.env_temp * effective_gradient) / (1 - effective_gradient) - target_temp
+
+    def temperature_update(self, read_time, temps):
+        # array version of ModelBasedController.temperature_update
+        np = self.np
+        self.model.advance_model(read_time - self.last_read_times[-1], self.current_heater_pwm, self.fan_power)
+        self.model.adjust_to_measurement(temps)
+
+        self.last_read_times.append(read_time)
+        self.last_read_times = self.last_read_times[1:]
+        tick_lens = [self.last_read_times[i] - self.last_read_times[i-1] for i in range(1, len(self.last_read_times))]
+        tick_len = sum(tick_lens) / len(tick_lens)
+
+        cells = self.model.cells
+        model_avg_temp = cells[:, 0].copy()
+        for i in range(1, cells.shape[1]-1):
+            model_avg_temp += cells[:, i]
+        model_avg_temp /= cells.shape[1]-1
+        degrees_needed = (self.target - model_avg_temp \
+                + self.stable_state_offset(self.target, self.fan_power)) * (cells.shape[1]-1)
+        self.current_heater_pwm = np.maximum(0.0, np.minimum(self.heater_max_power,
+                degrees_needed / (self.heater_output * tick_len)))
+        return self.current_heater_pwm
+
+    def tick(self):
+        offsets = self.disturbances.pop(self.tick_count, None)
+        effective_temp = self.sensor_temps()
+        if offsets is not None:
+            effective_temp = effective_temp + offsets
+        effective_temp = effective_temp + self._noise()
+        self.temperature_history.append(effective_temp)
+        heater_output = self.temperature_update(self.time, effective_temp)
+        self.temp_cells[:, 0] += TICK_LEN * heater_output * self.power * (self.temp_cells.shape[1]-1)
+        self.controller_decisions.append(heater_output)
+        self.dissipate_temps()
+        self.dissipate_temps()
+        self.tick_count += 1
+        self.time += TICK_LEN
+
+    def ticks(self, n):
+        for _ in range(n):
+            self.tick()
+
+    def sensor_temps(self):
+        return self.temp_cells[:, -2].copy()
@@ -0,0 +1,124 @@
+# Monte-Carlo evaluation of the model-based controller: runs many Sim scenarios
+# across a process pool and aggregates per-scenario control metrics
+#
+# A scenario is a dict:
+#   seed:         seed for the scenario's own random.Random (noise and disturbances)
+#   target:       target temperature
+#   noise:        sensor noise amplitude
+#   ticks:        how many ticks to simulate
+#   disturbances: list of (kind, degrees, in_ticks, duration), kind is 'soft' (Sim.disturb)
+#                 or 'hard' (Sim.disturb_hard)
+#   model_cfg:    controller model settings, as for Sim(model_cfg=...)
+
+import concurrent.futures
+import itertools, json, random
+import sim
+
+SETTLE_BAND = 2.0  # degrees around the target that count as settled
+STEADY_FRACTION = 0.2  # trailing fraction of the run used for the steady state error
+METRICS = ['overshoot', 'settling_time', 'steady_state_error', 'heater_duty']
+
+def grid(targets, noises, disturbance_schedules=([],), model_cfgs=(sim.DEFAULT_CFG,), ticks=600, seed=0):
+    # every combination of the given values, each with its own seed
+    scenarios = []
+    for i, (target, noise, disturbances, cfg) in enumerate(
+            itertools.product(targets, noises, disturbance_schedules, model_cfgs)):
+        scenarios.append({'seed': seed + i, 'target': target, 'noise': noise, 'ticks': ticks,
+            'disturbances': list(disturbances), 'model_cfg': dict(cfg)})
+    return scenarios
+
+def random_scenarios(count, seed=0, targets=(180, 250), noises=(0.0, 1.0), max_disturbances=3,
+        degrees=(-8, 8), model_cfgs=(sim.DEFAULT_CFG,), ticks=600):
+    # draws scenarios uniformly from the given (low, high) ranges
+    rng = random.Random(seed)
+    scenarios = []
+    for i in range(count):
+        disturbances = []
+        for _ in range(rng.randint(0, max_disturbances)):
+            duration = rng.randint(12, ticks // 4)
+            disturbances.append((rng.choice(['soft', 'hard']), rng.uniform(*degrees),
+                rng.randint(0, ticks - duration), duration))
+        scenarios.append({'seed': seed + i, 'target': rng.uniform(*targets), 'noise': rng.uniform(*noises),
+            'ticks': ticks, 'disturbances': disturbances, 'model_cfg': dict(rng.choice(model_cfgs))})
+    return scenarios
+
+def run_scenario(scenario):
+    s = sim.Sim(scenario['target'], randomness=scenario['noise'], model_cfg=scenario['model_cfg'],
+            rng=random.Random(scenario['seed']))
+    for kind, degrees, in_ticks, duration in scenario['disturbances']:
+        if kind == 'hard':
+            s.disturb_hard(degrees, in_ticks, duration)
+        else:
+            s.disturb(degrees, in_ticks, duration)
+    temps = []
+    for _ in range(scenario['ticks']):
+        s.tick()
+        temps.append(s.sensor_temp())
+    return evaluate(temps, s.controller_decisions[1:], scenario['target'])
+
+def evaluate(temps, pwm, target):
+    # temps are the true (noise free) plant temperatures, one per tick
+    overshoot = max(0.0, max(temps) - target)
+    outside = [i for i, t in enumerate(temps) if abs(t - target) > SETTLE_BAND]
+    if not outside:
+        settling_time = 0.0
+    elif outside[-1] == len(temps) - 1:
+        settling_time = float('inf')  # never settled
+    else:
+        settling_time = (outside[-1] + 1) * sim.TICK_LEN
+    steady = temps[-max(1, int(len(temps) * STEADY_FRACTION)):]
+    return {
+        'overshoot': overshoot,
+        'settling_time': settling_time,
+        'steady_state_error': sum(steady) / len(steady) - target,
+        'heater_duty': sum(pwm) / len(pwm),
+        }
+
+def run(scenarios, workers=None, chunksize=16):
+    # returns one metrics dict per scenario, in order
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(run_scenario, scenarios, chunksize=chunksize))
+
+def to_columns(scenarios, results):
+    cfg_keys = sorted(set(key for sc in scenarios for key in sc['model_cfg']))
+    columns = {
+        'seed': [sc['seed'] for sc in scenarios],
+        'target': [sc['target'] for sc in scenarios],
+        'noise': [sc['noise'] for sc in scenarios],
+        'ticks': [sc['ticks'] for sc in scenarios],
+        'disturbances': [len(sc['disturbances']) for sc in scenarios],
+        }
+    for key in cfg_keys:
+        columns['model_' + key] = [sc['model_cfg'].get(key) for sc in scenarios]
+    for metric in METRICS:
+        columns[metric] = [res[metric] for res in results]
+    return columns
+
+def write_results(filename, scenarios, results):
+    # one JSON list per column; infinite settling times are written as null
+    columns = to_columns(scenarios, results)
+    columns['settling_time'] = [None if t == float('inf') else t for t in columns['settling_time']]
+    with open(filename, 'w') as f:
+        json.dump(columns, f)
+
+def summarize(results):
+    summary = {}
+    for metric in METRICS:
+        values = sorted(res[metric] for res in results)
+        summary[metric] = {'mean': sum(values) / len(values), 'median': values[len(values) // 2],
+                'p95': values[min(len(values)-1, int(len(values) * 0.95))]}
+    return summary
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Monte-Carlo sweep of the model-based controller")
+    parser.add_argument('output', help="columnar JSON results file")
+    parser.add_argument('--scenarios', type=int, default=1000)
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    scenarios = random_scenarios(args.scenarios, args.seed, ticks=args.ticks)
+    results = run(scenarios, args.workers)
+    write_results(args.output, scenarios, results)
+    print(json.dumps(summarize(results), indent=2))
@@ -0,0 +1,56 @@
+import pytest
+from autotune_fit import EPSILON, TARGET_IS_HIGHER, TARGET_IS_LOWER, bin_search_float, kary_search_float
+
+def _feedback(error):
+    if error == 0:
+        return None
+    return TARGET_IS_HIGHER if error > 0 else TARGET_IS_LOWER
+
+def _serial(error_fn, lower, upper):
+    # drives bin_search_float like TraceFit._fit_model's binsearch_param
+    search = bin_search_float(lower, upper)
+    probe = next(search)
+    try:
+        while True:
+            error = error_fn(probe)
+            if error == 0:
+                break
+            probe = search.send(_feedback(error))
+    except StopIteration:
+        pass
+    return probe
+
+def _parallel(error_fn, lower, upper, k):
+    # drives kary_search_float like binsearch_param's ksearch_param
+    search = kary_search_float(lower, upper, k)
+    probes = next(search)
+    try:
+        while True:
+            assert 0 < len(probes) <= k
+            probes = search.send([_feedback(error_fn(probe)) for probe in probes])
+    except StopIteration as e:
+        return e.value
+
+def _towards(target):
+    return lambda x: target - x
+
+def _plateau(low, high):
+    # any value in [low, high] is a perfect fit
+    return lambda x: low - x if x < low else (high - x if x > high else 0)
+
+@pytest.mark.parametrize('k', [1, 2, 3, 4, 7, 8])
+@pytest.mark.parametrize('error_fn, target', [
+        (_towards(0.1234567), 0.1234567),
+        (_towards(0.999), 0.999),
+        (_towards(5.3), 5.3),  # beyond the initial upper bound
+        (_towards(0.375), 0.375),  # probed exactly on the way
+        (_towards(0.0), 0.0),
+        (_plateau(0.3, 0.45), None),
+        ])
+def test_kary_search_ends_where_bisection_does(k, error_fn, target):
+    serial = _serial(error_fn, 0.0, 1.0)
+    assert _parallel(error_fn, 0.0, 1.0, k) == serial
+    if target is not None:
+        assert abs(serial - target) <= EPSILON
+    else:
+        assert error_fn(serial) == 0
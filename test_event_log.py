@@ -0,0 +1,16 @@
+from array import array
+import event_log
+
+def test_restart_keeps_previous_logs(tmp_path):
+    path = str(tmp_path / 'heater.log')
+    for run in range(event_log.EventLog.KEEP + 3):
+        log = event_log.EventLog(path, 3, {'run': run})
+        log.record(float(run), 200.0, 210.0, 0.0, 0.5, array('d', [1.0, 2.0, 3.0]))
+        log.close()
+    names = sorted(p.name for p in tmp_path.iterdir())
+    assert names == ['heater.log'] + ['heater.log.%d' % i for i in range(1, event_log.EventLog.KEEP + 1)]
+    last = event_log.EventLog.KEEP + 2
+    for i, name in enumerate(names):
+        settings, records = event_log.read(str(tmp_path / name))
+        assert settings['run'] == last - i
+        assert records[0, 0] == last - i
@@ -0,0 +1,21 @@
+import os, shutil
+import fleet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class MemoryStore(dict):
+    def put(self, key, result):
+        self[key] = result
+
+def test_broken_traces_are_reported_not_raised(tmp_path):
+    # a trace cut short mid run, and a file that isn't a trace at all
+    with open(os.path.join(HERE, 'heattest_200')) as f:
+        lines = f.readlines()
+    truncated = tmp_path / 'truncated'
+    truncated.write_text(''.join(lines[:1000] + [line for line in lines if line.startswith('phase ')]))
+    shutil.copy(os.path.join(HERE, 'measurements'), str(tmp_path / 'measurements'))
+    assert fleet.find_traces(str(tmp_path)) == [str(truncated)]
+    store = MemoryStore()
+    results = fleet.run(fleet.find_traces(str(tmp_path)), store, workers=1)
+    assert results[str(truncated)]['error'].startswith('IndexError')
+    assert len(store) == 1
@@ -0,0 +1,65 @@
+import random
+import pytest
+import model
+
+def _sensor_trace(stepping, passes_per_sec, ticks=150):
+    # heat up, hold, then turn the fan on halfway through the hold
+    m = model.Model(20.0, 21.0, 0.2, 0.04, 0.05, 21.0, 6, passes_per_sec, stepping, trace=0)
+    trace = []
+    for tick in range(ticks):
+        trace.append(m.advance_model(0.833, 1.0 if tick < 60 else 0.3, 0.5 if tick > 100 else 0.0))
+    return trace, list(m.cells)
+
+def test_exact_stepping_is_the_limit_of_euler_passes():
+    exact_trace, exact_cells = _sensor_trace('exact', 3)
+    errors = []
+    for passes in (3, 30, 300):
+        trace, cells = _sensor_trace('euler', passes)
+        errors.append(max(abs(a - b) for a, b in zip(trace + cells, exact_trace + exact_cells)))
+    # euler is first order, so ten times the passes should cut the error about tenfold
+    for coarse, fine in zip(errors, errors[1:]):
+        assert fine < coarse / 5
+    assert errors[-1] < 5e-3
+
+def _random_params(rng, count):
+    return [dict(heater_power=rng.uniform(5.0, 30.0), initial_temp=rng.uniform(20.0, 60.0),
+            thermal_conductivity=rng.uniform(0.05, 0.5), base_cooling=rng.uniform(0.001, 0.1),
+            fan_cooling=rng.uniform(0.001, 0.2), env_temp=rng.uniform(15.0, 30.0)) for _ in range(count)]
+
+def test_batch_model_matches_scalar_models():
+    np = pytest.importorskip('numpy')
+    rng = random.Random(1)
+    params = _random_params(rng, 5)
+    models = [model.Model(metal_cells=4, passes_per_sec=5, trace=0, **p) for p in params]
+    batch = model.BatchModel.from_configs([dict(p, metal_cells=4, passes_per_sec=5) for p in params])
+    sensor_temps = []
+    for tick in range(300):
+        dt = rng.uniform(0.3, 1.5)
+        pwm = [rng.random() for _ in models]
+        fan = [rng.choice([0.0, rng.random(), 1.0]) for _ in models]
+        sensor_temps.append(batch.advance_model(dt, np.array(pwm), np.array(fan)))
+        expected = [m.advance_model(dt, p, f) for m, p, f in zip(models, pwm, fan)]
+        assert sensor_temps[-1].tolist() == expected
+        measured = [temp + rng.uniform(-2.0, 2.0) for temp in expected]
+        batch.adjust_to_measurement(np.array(measured))
+        for m, temp in zip(models, measured):
+            m.adjust_to_measurement(temp)
+        assert batch.cells.tolist() == [list(m.cells) for m in models]
+    # returned sensor temperatures don't change with later steps
+    assert sensor_temps[0].tolist() != sensor_temps[-1].tolist()
+
+@pytest.mark.parametrize('stepping', ['euler', 'exact'])
+def test_inplace_model_matches_model(stepping):
+    rng = random.Random(2)
+    params = _random_params(rng, 1)[0]
+    reference = model.Model(metal_cells=6, passes_per_sec=3, stepping=stepping, trace=0, **params)
+    inplace = model.InplaceModel(metal_cells=6, passes_per_sec=3, stepping=stepping, **params)
+    for tick in range(1000):
+        # ticks from a few lengths only, so exact stepping also reuses cached propagators
+        dt = rng.choice([0.8, 0.833, 1.2])
+        pwm, fan = rng.random(), rng.choice([0.0, 0.5, 1.0])
+        assert inplace.advance_model(dt, pwm, fan) == reference.advance_model(dt, pwm, fan)
+        temp = reference.cells[-2] + rng.uniform(-1.0, 1.0)
+        inplace.adjust_to_measurement(temp)
+        reference.adjust_to_measurement(temp)
+        assert list(inplace.cells) == reference.cells
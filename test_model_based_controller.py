@@ -0,0 +1,30 @@
+import random
+import model
+import sim
+
+class Fan(object):
+    speed = 0.0
+
+    def get_status(self, eventtime):
+        return {'speed': self.speed}
+
+def test_estimator_recovers_plant_parameters():
+    # the plant is the controller's own model with different heater power and cooling, so the
+    # estimates have a known right answer
+    true = dict(heater_power=2.0, base_cooling=0.004, fan_cooling=0.012)
+    plant = model.Model(true['heater_power'], 21.0, 0.05, true['base_cooling'], true['fan_cooling'], 21.0, 5, 3, trace=0)
+    cfg = dict(heater_power=1.5, thermal_conductivity=0.05, base_cooling=0.008, fan_cooling=0.006,
+            initial_temp=21.0, env_temp=21.0, metal_cells=5, estimate=True)
+    controller = sim.ModelBasedController(sim.FakeHeater(), sim.FakeConfig(cfg))
+    controller.fan = fan = Fan()
+    rng = random.Random(0)
+    for tick in range(8000):
+        # changing targets and fan speeds, so every parameter gets excited
+        target = [150.0, 220.0, 180.0, 240.0][(tick // 400) % 4]
+        fan.speed = [0.0, 0.0, 1.0, 0.5][(tick // 1000) % 4]
+        controller.temperature_update(tick * sim.TICK_LEN, plant.cells[-2] + rng.uniform(-0.1, 0.1), target)
+        plant.advance_model(sim.TICK_LEN, controller.current_heater_pwm, fan.speed)
+    estimates = controller.estimator.get_status()
+    for name, value in true.items():
+        assert abs(estimates[name] - value) < 0.03 * value, (name, estimates[name])
+    assert controller.heater_output == estimates['heater_power']
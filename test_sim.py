@@ -0,0 +1,50 @@
+import random
+import pytest
+import sim
+
+np = pytest.importorskip('numpy')
+
+CONFIGS = [
+        sim.DEFAULT_CFG,
+        dict(sim.DEFAULT_CFG, heater_power=2.5, base_cooling=0.006),
+        dict(sim.DEFAULT_CFG, steadystate_offset_base=0.02),
+        ]
+TARGETS = [210, 180, 240]
+
+def _disturb(s, row=None):
+    # the same schedule for Sim and BatchSim, a soft and a hard disturbance per scenario
+    args = () if row is None else (row,)
+    s.disturb(*args, degrees=-5, in_ticks=150, duration=30)
+    s.disturb_hard(*args, degrees=3, in_ticks=250, duration=12)
+
+def test_batch_sim_matches_sim():
+    ticks = 400
+    sims = []
+    for seed, (target, cfg) in enumerate(zip(TARGETS, CONFIGS)):
+        s = sim.Sim(target, model_cfg=cfg, rng=random.Random(seed))
+        _disturb(s)
+        s.ticks(ticks)
+        sims.append(s)
+    batch = sim.BatchSim(TARGETS, model_cfgs=CONFIGS, rngs=[random.Random(seed) for seed in range(len(TARGETS))])
+    for row in range(len(TARGETS)):
+        _disturb(batch, row)
+    batch.ticks(ticks)
+    temps = np.array(batch.temperature_history)
+    decisions = np.array(batch.controller_decisions)
+    for row, s in enumerate(sims):
+        # Sim's histories start with a placeholder entry
+        np.testing.assert_allclose(temps[:, row], s.temperature_history[1:], rtol=0, atol=1e-9)
+        np.testing.assert_allclose(decisions[:, row], s.controller_decisions[1:], rtol=0, atol=1e-9)
+    # the disturbances did show up
+    assert min(temps[150:200, 0]) < TARGETS[0] - 3
+
+@pytest.mark.parametrize('cfg', [
+        dict(sim.DEFAULT_CFG, metal_cells=4),
+        dict(sim.DEFAULT_CFG, passes_per_sec=10),
+        dict(sim.DEFAULT_CFG, stepping='exact'),
+        dict(sim.DEFAULT_CFG, estimate=True),
+        dict(sim.DEFAULT_CFG, tick_budget=0.001),
+        ])
+def test_batch_sim_rejects_mixed_rows(cfg):
+    with pytest.raises(ValueError):
+        sim.BatchSim([200, 200], model_cfgs=[sim.DEFAULT_CFG, cfg])
@@ -0,0 +1,22 @@
+import json, os, subprocess, sys
+
+# What Klipper does on the printer host: load the modules, set up a controller and the autotuner
+# and feed them temperatures. Runs in a fresh interpreter so nothing is imported already.
+STARTUP = """
+import json, sys
+import model, model_based_controller, shell_autotune, sim
+controller = model_based_controller.ModelBasedController(sim.FakeHeater(), sim.FakeConfig(sim.DEFAULT_CFG))
+tune = shell_autotune.ControlAutoTune(sim.FakeHeater(), 200)
+for tick in range(100):
+    controller.temperature_update(tick * sim.TICK_LEN, 100.0, 200.0)
+    tune.temperature_update(tick * sim.TICK_LEN, 100.0 + tick, 200.0)
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules))))
+"""
+
+def test_printer_side_imports_stay_light():
+    # shell_autotune.load_config only registers a gcode command, constructing ControlAutoTune covers more
+    out = subprocess.check_output([sys.executable, '-c', STARTUP], cwd=os.path.dirname(os.path.abspath(__file__)))
+    modules = set(json.loads(out.decode('utf-8')))
+    assert not modules & set(['numpy', 'scipy', 'matplotlib'])
+    # the fitting code is only loaded once a calibration run has been recorded
+    assert 'autotune_fit' not in modules
@@ -0,0 +1,198 @@
+# Heater trace files, as recorded by ControlAutoTune
+#
+# Two formats are supported:
+#  - the original text format: "pwm: <time> <value>" lines, "<time> <temp>" sample lines
+#    and "phase <name> start: <idx>" lines, in any order. TextRecorder streams it during a run
+#  - a columnar binary format that numpy can memory-map without parsing:
+#        magic      8 bytes   b'OHTRACE1'
+#        header     4 x uint32 (little endian): json length, sample count, pwm count, reserved
+#        json       phase markers, {"phase_start": {...}}, zero-padded to a multiple of 8 bytes
+#        timestamps float64[samples]
+#        temps      float64[samples]
+#        pwm        float64[pwm count][2]  (time, value)
+
+import json, struct, sys
+import queue, threading
+from array import array
+
+MAGIC = b'OHTRACE1'
+HEADER = struct.Struct('<8sIIII')
+
+def is_binary(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def is_trace(filename):
+    # cheap check for either format: the binary magic, or a first line as read_text expects it
+    if is_binary(filename):
+        return True
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                break
+        else:
+            return False
+    if line.startswith(b'pwm: ') or line.startswith(b'phase '):
+        return True
+    fields = line.split(b' ')
+    try:
+        [float(field) for field in fields]
+    except ValueError:
+        return False
+    return len(fields) == 2
+
+def read_text(filename):
+    # returns (timestamps, temps, pwm_samples, phase_start), streaming the file line by line
+    timestamps = array('d')
+    temps = array('d')
+    pwm_samples = []
+    phase_start = {}
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            if line.startswith('pwm: '):
+                _, time, val = line.split(' ')
+                pwm_samples.append((float(time), float(val)))
+            elif line.startswith('phase '):
+                _, phase, _, idx = line.split(' ')
+                phase_start[phase] = int(idx)
+            else:
+                time, temp = line.split(' ')
+                timestamps.append(float(time))
+                temps.append(float(temp))
+    return timestamps, temps, pwm_samples, phase_start
+
+def write_text(filename, timestamps, temps, pwm_samples, phase_start):
+    with open(filename, 'w') as f:
+        for time, value in pwm_samples:
+            f.write("pwm: %.3f %.3f\n" % (time, value))
+        for time, temp in zip(timestamps, temps):
+            f.write("%.3f %.3f\n" % (time, temp))
+        for phase, idx in phase_start.items():
+            f.write("phase %s start: %d\n" % (phase, idx))
+
+# Writes a text trace while it is being recorded. Samples go into a preallocated array buffer;
+# full buffers are handed to a background thread that formats and appends them to the file, and
+# come back to be reused, so recording neither blocks on disk nor grows with the run's length.
+class TextRecorder(object):
+    def __init__(self, filename, capacity=1024):
+        self.capacity = capacity
+        self.file = open(filename, 'w')
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        self.free.put(array('d', bytes(16 * capacity)))
+        self._next_buffer()
+        self.finished = False
+        self.thread = threading.Thread(target=self._write_loop, name='trace recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _next_buffer(self):
+        try:
+            self.buffer = self.free.get_nowait()
+        except queue.Empty:
+            # the writer is behind, don't wait for it
+            self.buffer = array('d', bytes(16 * self.capacity))
+        self.count = 0
+        # pwm and phase lines, which are rare, preformatted
+        self.events = []
+
+    def sample(self, time, temp):
+        if self.finished:
+            return
+        buf = self.buffer
+        buf[2*self.count] = time
+        buf[2*self.count+1] = temp
+        self.count += 1
+        if self.count == self.capacity:
+            self.flush()
+
+    def pwm(self, time, value):
+        if self.finished:
+            return
+        self.events.append("pwm: %.3f %.3f\n" % (time, value))
+
+    def phase(self, name, idx):
+        if self.finished:
+            return
+        self.events.append("phase %s start: %d\n" % (name, idx))
+
+    def flush(self):
+        # hand what's buffered to the writer thread
+        if self.count or self.events:
+            self.full.put((self.buffer, self.count, self.events))
+            self._next_buffer()
+
+    def finish(self):
+        # flush and let the writer close the file once it's done, without waiting for it
+        if not self.finished:
+            self.flush()
+            self.full.put(None)
+            self.finished = True
+
+    def close(self):
+        self.finish()
+        self.thread.join()
+
+    def _write_loop(self):
+        while True:
+            chunk = self.full.get()
+            if chunk is None:
+                break
+            buf, count, events = chunk
+            self.file.write(''.join(["%.3f %.3f\n" % (buf[2*i], buf[2*i+1]) for i in range(count)] + events))
+            self.file.flush()
+            self.free.put(buf)
+        self.file.close()
+
+def write_binary(filename, timestamps, temps, pwm_samples, phase_start):
+    if len(timestamps) != len(temps):
+        raise ValueError("got %d timestamps but %d temperatures" % (len(timestamps), len(temps)))
+    meta = json.dumps({'phase_start': dict(phase_start)}, sort_keys=True).encode('utf-8')
+    meta += b'\0' * (-len(meta) % 8)
+    pwm = array('d')
+    for time, value in pwm_samples:
+        pwm.append(float(time))
+        pwm.append(float(value))
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(meta), len(timestamps), len(pwm_samples), 0))
+        f.write(meta)
+        f.write(_little_endian(array('d', timestamps)).tobytes())
+        f.write(_little_endian(array('d', temps)).tobytes())
+        f.write(_little_endian(pwm).tobytes())
+
+def _little_endian(arr):
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+def read_binary(filename):
+    """Map a binary trace into memory.
+
+    Returns (timestamps, temps, pwm, phase_start), where timestamps and temps are read-only
+    numpy memmaps and pwm is a (count, 2) memmap of (time, value) rows.
+    """
+    import numpy as np
+    with open(filename, 'rb') as f:
+        magic, meta_len, samples, pwm_count, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary heater trace" % (filename,))
+        meta = json.loads(f.read(meta_len).rstrip(b'\0').decode('utf-8'))
+    offset = HEADER.size + meta_len
+    data = np.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(2*samples + 2*pwm_count,))
+    timestamps = data[:samples]
+    temps = data[samples:2*samples]
+    pwm = data[2*samples:].reshape(pwm_count, 2)
+    return timestamps, temps, pwm, meta['phase_start']
+
+def convert(text_filename, binary_filename):
+    write_binary(binary_filename, *read_text(text_filename))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit("usage: %s <text trace> <binary trace>" % (sys.argv[0],))
+    convert(sys.argv[1], sys.argv[2])